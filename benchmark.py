@@ -0,0 +1,220 @@
+"""Benchmark the cleaning and analysis stages of unicorn_pipeline on synthetic data.
+
+Generates files shaped like ``Modified_Unicorn_Companies.csv`` (with investor lists,
+misspelled industries, duplicated companies and a few bad ``Year Founded`` values), runs
+every stage of the pipeline on them and records wall time, CPU time, peak traced memory
+and row counts per stage as JSON, so results can be compared across versions:
+
+    python benchmark.py --rows 10000 1000000 --out results.json
+    python benchmark.py --rows 10000 --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import unicorn_pipeline as pipeline
+
+
+# Share of rows that repeat an earlier company, have a misspelled industry or a bad Year Founded
+duplicate_rate = 0.01
+misspelling_rate = 0.05
+bad_year_rate = 0.001
+
+# Number of distinct investors in the generated Select Investors lists
+investor_pool_size = 500
+
+# Rows of the file run once before the measured runs, so cold imports and caches are not timed
+warmup_rows = 1000
+
+locations = [('San Francisco', 'United States', 'North America'), ('New York', 'United States', 'North America'),
+             ('Toronto', 'Canada', 'North America'), ('Beijing', 'China', 'Asia'), ('Shanghai', 'China', 'Asia'),
+             ('Bengaluru', 'India', 'Asia'), ('Singapore', 'Singapore', 'Asia'), ('London', 'United Kingdom', 'Europe'),
+             ('Berlin', 'Germany', 'Europe'), ('Paris', 'France', 'Europe'), ('Stockholm', 'Sweden', 'Europe'),
+             ('Sao Paulo', 'Brazil', 'South America'), ('Bogota', 'Colombia', 'South America'),
+             ('Sydney', 'Australia', 'Oceania'), ('Lagos', 'Nigeria', 'Africa')]
+
+
+def generate_companies_csv(path, rows, seed=0, batch_rows=1_000_000):
+    """Write a synthetic companies file with rows rows to path, batch_rows at a time."""
+
+    rng = np.random.default_rng(seed)
+
+    # Investors ordered by popularity, with the Big 3 and a near-miss name at the top
+    investors = np.array(pipeline.big_3_investors + ['Accel Partners']
+                         + [f'Investor {i}' for i in range(investor_pool_size - 4)])
+    popularity = 1 / np.arange(1, len(investors) + 1)
+    popularity /= popularity.sum()
+
+    industries = np.array(pipeline.industry_list)
+    misspellings = np.array(list(pipeline.industry_dct) + ['FINTECH', 'Helth', 'Edtec', 'Cyber security'])
+    cities, countries, continents = (np.array(column) for column in zip(*locations))
+
+    for start in range(0, rows, batch_rows):
+        n = min(batch_rows, rows - start)
+        ids = np.arange(start, start + n)
+
+        # Some rows reuse the name of an earlier company
+        duplicate = (rng.random(n) < duplicate_rate) & (ids > 0)
+        ids[duplicate] = rng.integers(0, np.maximum(ids[duplicate], 1))
+        company = pd.Series(ids).map('Company {}'.format)
+
+        joined = pd.to_datetime('2007-01-01') + pd.to_timedelta(rng.integers(0, 16 * 365, n), unit='D')
+        founded = joined.year.to_numpy() - rng.integers(0, 25, n)
+        bad_year = rng.random(n) < bad_year_rate
+        founded[bad_year] = joined.year.to_numpy()[bad_year] + rng.integers(1, 10, bad_year.sum())
+
+        industry = industries[rng.integers(0, len(industries), n)]
+        misspelled = rng.random(n) < misspelling_rate
+        industry[misspelled] = misspellings[rng.integers(0, len(misspellings), misspelled.sum())]
+
+        location = rng.integers(0, len(locations), n)
+
+        # Between 1 and 4 distinct investors per company
+        first = rng.choice(len(investors), n, p=popularity)
+        quarter = len(investors) // 4
+        picks = [first] + [(first + rng.integers(j * quarter + 1, (j + 1) * quarter)) % len(investors)
+                           for j in range(3)]
+        count = rng.integers(1, 5, n)
+        select_investors = pd.Series(investors[picks[0]])
+        for j in range(1, 4):
+            select_investors = select_investors.where(count <= j, select_investors + ', ' + investors[picks[j]])
+
+        frame = pd.DataFrame({'Company': company,
+                              'Valuation': np.clip(rng.lognormal(1, 0.8, n).round().astype(int), 1, 200),
+                              'Date Joined': joined.strftime(pipeline.date_joined_format),
+                              'Industry': industry,
+                              'City': cities[location],
+                              'Country/Region': countries[location],
+                              'Continent': continents[location],
+                              'Year Founded': founded,
+                              'Funding': pd.Series(rng.integers(100, 5000, n)).map('${}M'.format),
+                              'Select Investors': select_investors})
+        frame.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+
+def run_stages(path, trace_memory=True):
+    """Run the pipeline stages on the file at path and return one result dict per stage."""
+
+    # The read of read_companies with its schema; Date Joined stays a category of strings here
+    # so that its parse is timed on its own in to_datetime
+    def load(_):
+        return pd.read_csv(path, dtype=pipeline.companies_dtypes)
+
+    def years_to_unicorn(frame):
+        return pipeline.add_years_to_unicorn(pipeline.fix_year_founded(frame))
+
+    def investor_flags(frame):
+        return pipeline.flag_investors(frame)
+
+    def aggregates(frame):
+        pipeline.investor_aggregates(frame, pipeline.big_3_investors)
+        return frame
+
+    stages = [('load', load), ('to_datetime', pipeline.parse_date_joined), ('years_to_unicorn', years_to_unicorn),
+              ('industry_normalization', pipeline.relabel_industry), ('dedup', pipeline.drop_duplicate_companies),
+              ('encodings', pipeline.encode_companies), ('investor_flags', investor_flags),
+              ('step4_aggregates', aggregates)]
+
+    results = []
+    frame = None
+    for name, stage in stages:
+        rows_in = 0 if frame is None else len(frame)
+
+        if trace_memory:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        frame = stage(frame)
+
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        results.append({'stage': name, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                        'peak_traced_bytes': peak, 'rows_in': rows_in, 'rows_out': len(frame)})
+
+    return results
+
+
+def compare(results, baseline, threshold=1.25):
+    """Print the wall time ratio of every stage against baseline and return the regressed stages."""
+
+    previous = {(run['rows'], stage['stage']): stage for run in baseline['runs'] for stage in run['stages']}
+
+    regressions = []
+    for run in results['runs']:
+        for stage in run['stages']:
+            old = previous.get((run['rows'], stage['stage']))
+            if old is None:
+                continue
+            ratio = stage['wall_seconds'] / max(old['wall_seconds'], 1e-9)
+            flag = ' REGRESSION' if ratio > threshold else ''
+            print(f"{run['rows']:>10} {stage['stage']:<24} {old['wall_seconds']:9.3f}s -> "
+                  f"{stage['wall_seconds']:9.3f}s  x{ratio:.2f}{flag}")
+            if flag:
+                regressions.append((run['rows'], stage['stage'], ratio))
+
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmark command line and return its exit status."""
+
+    parser = argparse.ArgumentParser(description='Benchmark the unicorn_pipeline stages on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 1_000_000, 10_000_000],
+                        help='sizes of the synthetic files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--data-dir', default='benchmark_data', help='directory for the synthetic files')
+    parser.add_argument('--out', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='wall time ratio reported as a regression')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory (faster)')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    # Warm up on a small file first; the first measured size would otherwise pay for the lazy imports
+    warmup_path = os.path.join(args.data_dir, f'companies-{warmup_rows}-{args.seed}.csv')
+    if not os.path.exists(warmup_path):
+        generate_companies_csv(warmup_path, warmup_rows, args.seed)
+    run_stages(warmup_path, trace_memory=False)
+
+    results = {'python': platform.python_version(), 'platform': platform.platform(),
+               'numpy': np.__version__, 'pandas': pd.__version__, 'seed': args.seed, 'runs': []}
+
+    for rows in args.rows:
+        path = os.path.join(args.data_dir, f'companies-{rows}-{args.seed}.csv')
+        if not os.path.exists(path):
+            generate_companies_csv(path, rows, args.seed)
+
+        stages = run_stages(path, trace_memory=not args.no_memory)
+        results['runs'].append({'rows': rows, 'stages': stages})
+
+        for stage in stages:
+            peak = stage['peak_traced_bytes']
+            peak = f'{peak / 1024 ** 2:10.1f} MB' if peak is not None else f"{'-':>13}"
+            print(f"{rows:>10} {stage['stage']:<24} {stage['wall_seconds']:9.3f}s {peak} {stage['rows_out']:>10} rows")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,6 +10,8 @@
 # ## Step 1: Imports 
 
 # Import relevant Python libraries and packages: `numpy`, `pandas`, `seaborn`, and `pyplot` from `matplotlib`.
+# 
+# The cleaning and analysis functions used in this notebook live in `unicorn_pipeline.py`, which can also be imported on its own or run from the command line (`python unicorn_pipeline.py validate|clean|report ...`) without loading the plotting libraries.
 
 # In[1]:
 
@@ -23,6 +25,17 @@ import numpy as np
 import seaborn as sns
 import pandas as pd
 
+# The cleaning and analysis steps are kept as functions in unicorn_pipeline.py
+from unicorn_pipeline import (InvestorIndex, QuantileSketch, QueryService, backend_parity, benchmark_load,
+                              big_3_investors, clean_companies, clean_companies_parallel,
+                              clean_companies_streaming, co_investment_groups, co_investment_pairs,
+                              compact_companies, date_joined_format, dedup_out_of_core, exact_quantiles,
+                              fit_encoders, fix_year_founded, flag_investors, industry_dct, industry_list,
+                              industry_review_queue, instrument, investor_aggregates, investor_matrix,
+                              normalize_industry, parse_dates, quantile_codes, quantile_sketch,
+                              read_companies, render_investor_charts, save_cleaned_cache,
+                              update_incremental_state, validate, validation_rules, year_founded_fixes)
+
 
 # ### Load the dataset
 # 
@@ -34,7 +47,7 @@ import pandas as pd
 # Load the data.
 
 
-companies = pd.read_csv('Modified_Unicorn_Companies.csv')
+companies = read_companies('Modified_Unicorn_Companies.csv')
 
 # Display the first five rows.
 
@@ -42,6 +55,23 @@ companies = pd.read_csv('Modified_Unicorn_Companies.csv')
 companies.head()
 
 
+# ### Benchmark the schema loader
+# 
+# To check that the declared schema pays off i compared the plain `read_csv` (every type inferred, `Date Joined` converted afterwards without a format) with `read_companies` on the C and pyarrow engines, and with `usecols` limited to the columns needed for the investor analysis. Each loader is timed over a few repeats and the memory of the resulting frame is measured.
+
+# In[ ]:
+
+
+# Compare load time and memory of the different loaders.
+
+
+# Set to True to run the loader benchmark
+run_load_benchmark = False
+
+if run_load_benchmark:
+    print(benchmark_load('Modified_Unicorn_Companies.csv'))
+
+
 # ## Step 2: Data cleaning
 # 
 
@@ -68,7 +98,9 @@ companies.dtypes
 
 
 
-companies['Date Joined'] = pd.to_datetime(companies['Date Joined'])
+# Date Joined is already parsed by read_companies, this keeps the conversion explicit
+# (parse_dates parses each distinct date string once and broadcasts it to the rows)
+companies['Date Joined'] = parse_dates(companies['Date Joined'], format=date_joined_format)
 
 
 # ### Create a new column
@@ -104,11 +136,12 @@ print('Companies with a negative Years To Unicorn (before cleaning):')
 # Determine which companies have a negative years to unicorn
 print(companies[companies['Years To Unicorn'] < 0]['Company'].values)
 
-# Replacing the Year Founded for InVision with 2011 (which was determined from an internet search)
-companies.loc[companies['Company'] == 'InVision', 'Year Founded'] = 2011
+# Manual Year Founded corrections (InVision's 2011 was determined from an internet search)
+print(year_founded_fixes)
 
-# Recalculating the Years to Unicorn column (to correct Invision's value)
-companies['Years To Unicorn'] = companies['Date Joined'].dt.year - companies['Year Founded']
+# Replacing the Year Founded for each corrected company and recalculating the Years to Unicorn
+# of those rows only (to correct Invision's value)
+companies = fix_year_founded(companies)
 
 # Calculate which companies have a negative years to unicorn to ensure data was properly cleaned
 print('Companies with a negative Years To Unicorn (after cleaning):')
@@ -119,7 +152,7 @@ print(companies[companies['Years To Unicorn'] < 0]['Company'].values)
 
 
 # List provided by the company of the expected industry labels in the data
-industry_list = ['Artificial intelligence', 'Other','E-commerce & direct-to-consumer', 'Fintech',       'Internet software & services','Supply chain, logistics, & delivery', 'Consumer & retail',       'Data management & analytics', 'Edtech', 'Health', 'Hardware','Auto & transportation',         'Travel', 'Cybersecurity','Mobile & telecommunications']
+industry_list
 
 
 # Verify the industry labels provided by the business are the only possible values in `Industry`. If there are additional labels, correct the data so only the preceding labels are present in `Industry`.
@@ -133,18 +166,39 @@ industry_list = ['Artificial intelligence', 'Other','E-commerce & direct-to-cons
 # Print the number of unique industries before any corrections
 print(companies['Industry'].nunique())
 
-# Define a dictionary that maps the incorrect industry spellings to their correct industry spelling
-industry_dct = {'Artificial Intelligence':'Artificial intelligence',
-                'Data management and analytics':'Data management & analytics',
-                'FinTech':'Fintech'}
+# Dictionary that maps the incorrect industry spellings to their correct industry spelling
+print(industry_dct)
 
-# Rename the misspelled industry labels according to the dictionary defined above
+# Rename the misspelled industry labels according to the dictionary
 companies['Industry'] = companies['Industry'].replace(industry_dct)
 
+# Drop the misspelled labels from the categories so they do not become empty dummy columns
+companies['Industry'] = companies['Industry'].astype('category').cat.remove_unused_categories()
+
 # Print the number of unique industries to validate only 15 are present
 print(companies['Industry'].nunique())
 
 
+# ### Normalize Industry labels automatically
+# 
+# `industry_dct` only fixes the misspellings that were found by hand, so a new one would slip through. `normalize_industry` maps every distinct `Industry` value onto `industry_list`: first through `industry_dct`, then by an exact match after case-folding (and writing "and" as "&"), and otherwise by the closest label by edit similarity (`difflib`). Only the distinct labels are matched, and the result is broadcast to the rows through the category codes, so the cost does not depend on the number of rows.
+# 
+# Matches are memoized in `industry_matches`, which can be saved to and loaded from a JSON file so later runs skip the matching. A label whose best match scores below `industry_match_threshold` is left unchanged and added to `industry_review_queue` for a person to check; the `expected industry label` validation rule will also report it. Until it is resolved the company gets 0 in every `Industry` dummy column, since the fitted `Industry` encoder ignores labels outside `industry_list`. From the command line, `--industry-matches industry_matches.json` keeps the matches between runs, and the labels waiting for review are printed at the end of every command (and written to a CSV file with `--review-queue`).
+
+# In[ ]:
+
+
+# Map the Industry labels onto industry_list with a cached fuzzy match.
+
+
+# Normalize the Industry labels and check that none are waiting for review
+companies['Industry'] = normalize_industry(companies['Industry'])
+
+print(companies['Industry'].nunique())
+print('Industry labels waiting for review:')
+print(industry_review_queue)
+
+
 # The business mentioned that no `Company` should appear in the data more than once. I checked to Verify that this is true, and, if not, i cleaned the data so each `Company` appears only once.
 
 # In[ ]:
@@ -167,6 +221,50 @@ print('Number of duplicated companies (after cleaning):')
 print(companies['Company'].duplicated().sum())
 
 
+# ### Deduplicate files larger than memory
+# 
+# `drop_duplicates` needs the whole frame in memory. `dedup_out_of_core` does the same on a file of any size: it splits the rows into partition files on disk by a hash of `Company`, so every row of a company lands in the same partition, deduplicates one partition at a time, and writes the surviving rows back in their original file order. By default it keeps the first row of each company like `drop_duplicates`; the `policy` argument can keep the last row instead, or the row with the latest `Date Joined` (see `dedup_policies`).
+
+# In[ ]:
+
+
+# Remove duplicate companies from the file without loading it into memory.
+
+
+# Set to True to write a deduplicated copy of the file
+run_out_of_core_dedup = False
+
+if run_out_of_core_dedup:
+    dedup_counts = dedup_out_of_core('Modified_Unicorn_Companies.csv', 'Modified_Unicorn_Companies_dedup.csv')
+    print('Number of duplicated companies (before cleaning):')
+    print(dedup_counts['duplicates'])
+
+
+# ### Validate with declarative rules
+# 
+# The checks above were written one at a time. The same checks are written as a list of rules (`validation_rules` in `unicorn_pipeline.py`), so new checks can be added without new code. Each rule is one of:
+# 
+# * `range` - values of `column` must be between `min` and `max` (either can be left out)
+# * `allowed` - values of `column` must be in `values`
+# * `unique` - values of `column` must not repeat
+# * `check` - a cross-column `expression` (as accepted by `DataFrame.eval`) must be true
+# * `override` - rows whose `key` is in the `values` table must have that value in `column`
+# 
+# `compile_rules` turns the rules into vectorized checks that each return a mask over the whole frame, and `validate` evaluates them in one pass and returns one row per violation with its row id. `validate_chunks` does the same over a stream of chunks and keeps the seen values of the `unique` rules across chunks.
+
+# In[ ]:
+
+
+# Validate the companies data against a declarative rule set.
+
+
+# Validate the cleaned data and display the number of violations of each rule
+violations = validate(companies)
+
+print('Rule violations after cleaning:')
+print(violations['rule'].value_counts().reindex([rule['name'] for rule in validation_rules], fill_value=0))
+
+
 # **Question: Why is it important to perform input validation?**
 # 
 # Input validation is an essential practice for ensuring data is complete, error-free, and high quality. A low-quality dataset may lend itself to an analysis that is incorrect or misleading.
@@ -201,6 +299,56 @@ companies['High Valuation'] = pd.qcut(companies['Valuation'], 2, labels = ['No',
 companies['High Valuation'] = companies['High Valuation'].cat.codes
 
 
+# ### Valuation tiers without sorting the whole column
+# 
+# `pd.qcut` needs the whole `Valuation` column in memory to find the median, which is not possible in the streaming, parallel or out-of-core modes. `QuantileSketch` summarizes a column in a few hundred values, can be built chunk by chunk or per partition and merged, and returns approximate quantiles whose rank is off by at most `rank_error` rows. When the exact split is needed, `exact_quantiles` makes a second pass over the chunks that only keeps the values close to each quantile. `quantile_codes` turns the bin edges into the same codes as `pd.qcut`, for any number of bins.
+
+# In[ ]:
+
+
+# Compute High Valuation from quantiles that can be computed over chunks.
+
+
+# Split companies into chunks of 500 rows, standing in for a stream or for partitions
+def companies_chunks():
+    return (companies.iloc[start:start + 500] for start in range(0, len(companies), 500))
+
+
+# Sketch of Valuation built on each chunk separately, merged into one
+valuation_sketch = QuantileSketch()
+for chunk in companies_chunks():
+    valuation_sketch.merge(quantile_sketch([chunk]))
+
+print('Approximate median Valuation and its maximum rank error:')
+print(valuation_sketch.quantiles([0.5]), valuation_sketch.rank_error)
+
+# Exact quartile edges in two passes over the same chunks
+valuation_edges = exact_quantiles(companies_chunks, [0, 0.25, 0.5, 0.75, 1])
+
+# Check that the exact median split gives the same High Valuation as qcut
+print('High Valuation matches qcut:')
+print((quantile_codes(companies['Valuation'], valuation_edges[[0, 2, 4]]) == companies['High Valuation']).all())
+
+# Display the number of companies in each Valuation quartile
+print(quantile_codes(companies['Valuation'], valuation_edges).value_counts().sort_index())
+
+
+# ### Fitted encoders
+# 
+# `pd.get_dummies` and `astype('category').cat.codes` derive their columns and codes from the values present in the data they are given, so two batches (or two chunks of a stream) can be encoded differently. The encoders in `unicorn_pipeline.py` are fitted once, saved to a JSON file and reused, so every batch gets the same codes and the same dummy columns.
+# 
+# Values that are not in the fitted vocabulary are handled by the `unknown` policy: `'error'` raises a `ValueError`, `'ignore'` gives them the code -1 and no dummy column. Codes are the smallest integer type that fits the vocabulary (int8 or int16), and dummies are uint8 columns, or sparse columns with `sparse=True`.
+
+# In[ ]:
+
+
+# Define encoders with a fixed vocabulary.
+
+
+# Fit the encoders on the cleaned data
+encoders = fit_encoders(companies)
+
+
 # ### Convert `Continent` to numeric
 
 # In[ ]:
@@ -210,8 +358,8 @@ companies['High Valuation'] = companies['High Valuation'].cat.codes
 
 
 
-# Create dummy variables with Continent values
-continents_encoded = pd.get_dummies(companies['Continent'], drop_first = True)
+# Create dummy variables with the fitted Continent values
+continents_encoded = encoders['Continent'].dummies(companies['Continent'], drop_first = True)
 
 # Add DataFrame with dummy Continent labels back to companies data.
 companies = pd.concat([companies, continents_encoded], axis=1)
@@ -225,8 +373,8 @@ companies = pd.concat([companies, continents_encoded], axis=1)
 # Convert Country/Region to numeric data.
 
 
-# Create numeric categoriews for Country/Region
-companies['Country/Region'] = companies['Country/Region'].astype('category').cat.codes
+# Create numeric categoriews for Country/Region with the fitted vocabulary
+companies['Country/Region'] = encoders['Country/Region'].codes(companies['Country/Region'])
 
 
 # ### Convert `Industry` to numeric
@@ -238,8 +386,8 @@ companies['Country/Region'] = companies['Country/Region'].astype('category').cat
 
 
 
-# Create dummy variables with Industry values
-industry_encoded = pd.get_dummies(companies['Industry'], drop_first = True)
+# Create dummy variables with the fitted Industry values
+industry_encoded = encoders['Industry'].dummies(companies['Industry'], drop_first = True)
 
 # Add DataFrame with dummy Industry labels back to companies data.
 companies = pd.concat([companies, industry_encoded], axis=1)
@@ -257,53 +405,189 @@ companies = pd.concat([companies, industry_encoded], axis=1)
 # Created three dummy variables (one for each investor) that denotes if the following investors are included as `Select Investors`: Sequoia Capital, Tiger Global Management, and Accel.
 # 
 # For the purpose of this lab, these investors are called the 'Big 3' unicorn investment groups.
+# 
+# Searching `Select Investors` with `str.contains` once per investor scans the whole column each time, and `'Accel'` also matched investors that only contain that text (such as `'Accel Partners'`). Instead, `Select Investors` is split into investor names once and turned into a sparse company x investor matrix. Any number of investors can then be flagged in one pass by exact name. Names are compared after trimming, collapsing repeated spaces and case-folding.
 
 # In[ ]:
 
 
-# Create a dummy variable that denotes if Sequoia Capital is a Select Investor.
+# Split Select Investors into investor names and flag the Big 3 investors.
 
- 
 
-companies['Sequoia Capital'] = companies['Select Investors'].str.contains('Sequoia Capital')
-companies['Sequoia Capital'] = companies['Sequoia Capital'].astype(int)
+companies = flag_investors(companies)
+
+
+# **Question: How does label encoding change the data?**
+# 
+# Labeled encoding changes in the data by assigning each category a unique number instead of a qualitative value. 
+
+# **Question: What are the benefits of label encoding?**
+# 
+# Label encoding is effective when there are a large number of categorical variables and when the variables have a particular order. It is useful in machine learning models, such as decision trees and random forests.
 
+# **Question: What are the disadvantages of label encoding?**
+# 
+# Label encoding may make it more difficult to directly interpet what a column value represents. Further, it may introduce an unintended relationship between the categorical data in a dataset.
+
+# ### Compact the cleaned data
+# 
+# The cleaned frame keeps strings as objects, 64-bit integers and a separate byte for every dummy and investor flag. `compact_companies` makes a smaller copy for keeping many frames in memory: it downcasts the numbers, turns repeated strings into categoricals (and the rest into Arrow-backed strings), and packs all the 0/1 indicator columns as bits of one integer column. `expand_indicators` unpacks them again. The report shows the bytes saved on each column.
 
 # In[ ]:
 
 
-# Create a dummy variable that denotes if Tiger Global Management is a Select Investor.
+# Compact the cleaned data and display the memory saved on each column.
 
 
-companies['Tiger Global Management'] = companies['Select Investors'].str.contains('Tiger Global Management')
-companies['Tiger Global Management'] = companies['Tiger Global Management'].astype(int)
+compact_companies_data, compaction_report = compact_companies(companies)
 
+print(compaction_report)
+print('Total bytes saved:')
+print(compaction_report['saved'].sum())
+
+
+# ### Streaming mode for large files
+# 
+# The steps above load the whole file into `companies` at once. For feeds with millions of rows i added a streaming mode that reads the file in chunks and runs the row-level cleaning steps (date parse, `Years To Unicorn`, the `Year Founded` corrections, the `industry_dct` relabeling and the Big 3 investor flags) on one chunk at a time, so peak memory is set by the chunk size and not by the size of the file.
+# 
+# The chunk size can be given directly as a number of rows, or as a byte budget that is converted to rows by measuring a sample of the file. Duplicate companies are dropped across chunks by keeping a set of the `Company` values already written, which keeps the first occurrence just like `drop_duplicates`. That set is the only state that grows with the input.
 
 # In[ ]:
 
 
-# Create a dummy variable that denotes if Accel is a Select Investor.
+# Stream the cleaning steps over the file in chunks.
 
 
+# Set to True to write a cleaned copy of the file using the streaming mode
+run_streaming = False
 
-companies['Accel'] = companies['Select Investors'].str.contains('Accel')
-companies['Accel'] = companies['Accel'].astype(int)
+if run_streaming:
+    print('Rows written by the streaming cleaner:')
+    print(clean_companies_streaming('Modified_Unicorn_Companies.csv', 'Modified_Unicorn_Companies_clean.csv'))
 
 
-# **Question: How does label encoding change the data?**
+# ### Cache the cleaned data
 # 
-# Labeled encoding changes in the data by assigning each category a unique number instead of a qualitative value. 
+# Every run repeats the parse, the corrections, the dedup and the encodings before any analysis happens. The cleaned `companies` frame is saved to an Arrow file in `.companies_cache/`, named after a hash of the source file and a hash of the cleaning rules (`industry_dct`, `industry_list`, `year_founded_fixes` and the column schema). Changing either the data or the rules gives a new file name, so an old cache is never read by mistake. Later runs memory-map the Arrow file instead of cleaning again.
+# 
+# Bump `cleaning_rules_revision` whenever the cleaning code itself changes.
 
-# **Question: What are the benefits of label encoding?**
+# In[ ]:
+
+
+# Save and load the cleaned companies data.
+
+
+# Set to True to save the cleaned companies frame to the cache
+run_cache = False
+
+if run_cache:
+    print('Cleaned data cached in:')
+    print(save_cleaned_cache(companies, 'Modified_Unicorn_Companies.csv'))
+
+
+# ### Incremental cleaning of new records
 # 
-# Label encoding is effective when there are a large number of categorical variables and when the variables have a particular order. It is useful in machine learning models, such as decision trees and random forests.
+# The feed only adds a few thousand companies a day, but every refresh cleaned the whole history again. The incremental mode keeps the cleaned rows in a state directory as one Arrow part file per update. The companies of each part are also appended to a keys file, the persistent set of companies already seen. Each update reads the file as text, drops the rows of companies in that set (and repeats inside the update), and converts, cleans and encodes only the rows that are left. Because the history always comes first in file order, this keeps the first occurrence of each company exactly like `drop_duplicates(subset=['Company'])` on the full file.
+# 
+# The encoders of the state are fitted on the first update and saved with it, so the parts are stored already encoded. The sorted `Country/Region` codes and the `drop_first` dummies depend on every row, so an update that brings a new `Continent` or `Country/Region` grows the encoders and re-encodes the earlier parts; that is the only time an update touches the history. The encoders and the parts encoded with them are kept together in a generation directory named by the `CURRENT` file. A re-encode writes a new generation and only switches `CURRENT` to it once every part is written, so a crash in the middle leaves the old generation in use and untouched. The `High Valuation` median split is computed when the state is loaded.
 
-# **Question: What are the disadvantages of label encoding?**
+# In[ ]:
+
+
+# Clean only the new records and add them to the saved state.
+
+
+# Set to True to add the new records of the file to the incremental state
+run_incremental = False
+
+if run_incremental:
+    print('New companies added to the incremental state:')
+    print(update_incremental_state('.companies_state', 'Modified_Unicorn_Companies.csv'))
+
+
+# ### Parallel cleaning across CPU cores
 # 
-# Label encoding may make it more difficult to directly interpet what a column value represents. Further, it may introduce an unintended relationship between the categorical data in a dataset.
+# The cleaning steps above run on one core. The parallel mode splits the rows into partitions by a hash of `Company`, so every row of a company lands in the same partition, and cleans the partitions in a pool of processes. Each partition runs the date parse, `Years To Unicorn`, the `Year Founded` corrections, the industry relabeling, the investor flags and its own `drop_duplicates(subset=['Company'])`. Since the rows keep their file order inside a partition, the row that survives is the same first occurrence as in the single-process run. The partitions are put back together in the original row order at the end.
+# 
+# Reading the file with `engine='pyarrow'` also parses the CSV on several threads.
+
+# In[ ]:
+
+
+# Clean the companies data in parallel partitions.
+
+
+# Set to True to clean the file with the parallel mode
+run_parallel = False
+
+if run_parallel:
+    print('Rows left after parallel cleaning:')
+    print(len(clean_companies_parallel(read_companies('Modified_Unicorn_Companies.csv', engine='pyarrow'))))
+
+
+# ### Measure every cleaning stage
+# 
+# The prints in this notebook only show the results of the cleaning, not what each step costs. Every stage in `unicorn_pipeline.py` (the load, the date parse, the `Year Founded` corrections, `Years To Unicorn`, the industry relabeling, the dedup, the encodings, the investor flags and the investor aggregates) reports a record to the hooks registered with `instrument`: wall time, CPU time, the peak resident memory above the start of the stage (or with `trace_memory=True` the peak memory traced by `tracemalloc`), rows in and out, and optionally the rows whose existing values it changed. A hook is any function taking the record, such as `list.append` or a `JsonLinesExporter` that appends the records to a file. `instrument` can also save a `cProfile` file for every stage call.
+# 
+# From the command line the same records are written with `python unicorn_pipeline.py --metrics stage_metrics.jsonl report ...`, so a slow nightly run shows which stage grew.
+
+# In[ ]:
+
+
+# Measure the cleaning stages.
+
+
+# Set to True to clean the file again with every stage measured
+run_instrumentation = False
+
+if run_instrumentation:
+    stage_records = []
+    with instrument(stage_records.append, rows_modified=True):
+        clean_companies(read_companies('Modified_Unicorn_Companies.csv'))
+
+    print(pd.DataFrame(stage_records)[['stage', 'wall_seconds', 'cpu_seconds', 'memory_delta_bytes',
+                                       'rows_in', 'rows_out', 'rows_modified']])
+
+
+# ### Run the cleaning on a lazy backend
+# 
+# Every step above runs on eager pandas, so each intermediate is a full copy of the data. `clean_with_backend` runs the same steps (date parse, `Year Founded` corrections, `Years To Unicorn`, industry relabeling, dedup, encodings and investor flags) on a backend chosen by name. `'pandas'` is the default and calls the functions used in this notebook. `'polars'` builds one lazy Polars query, so only the columns and rows an analysis needs are read from the file, and the work is spread over all cores. The industry mapping, the `Year Founded` corrections and the encoder vocabularies are the same for both backends.
+# 
+# `backend_parity` cleans the file and computes the Big 3 results with every backend and compares them with pandas: the InVision fix, the industry mapping, the dedup, the encodings, the investor flags, the Big 3 summary, top companies and overlap. The same check runs from the command line with `python unicorn_pipeline.py parity Modified_Unicorn_Companies.csv` (Polars has to be installed).
+
+# In[ ]:
+
+
+# Check that the pandas and Polars backends give the same results.
+
+
+# Set to True to compare the backends (needs polars)
+run_backend_parity = False
+
+if run_backend_parity:
+    print(backend_parity('Modified_Unicorn_Companies.csv')[['check', 'backend', 'passed']])
+
 
 # ## Step 3: Model building
 
+# ### Aggregate the statistics of every investor at once
+# 
+# The plots and the results below used to filter the whole frame again for every investor and every statistic. `investor_aggregates` instead builds one long table with a row per (company, investor) pair from the company x investor matrix and computes every per-investor statistic from it with a single `groupby` each: the number of companies, the mean and median `Years To Unicorn`, the `Industry` and `Continent` histograms, and the top k companies by `Valuation` (selected with `nlargest` instead of sorting everything).
+# 
+# When a list of investors is given only those are aggregated, under the names given; otherwise every investor in `Select Investors` is, under its normalized name.
+
+# In[ ]:
+
+
+# Compute the per-investor statistics in one pass.
+
+
+big_3_aggregates = investor_aggregates(companies, big_3_investors)
+
+print(big_3_aggregates['summary'])
+
+
 # Created three bar plots to visualize the distribution of investments by industry for the following unicorn investors: Sequoia Capital, Tiger Global Management, and Accel.
 
 # In[ ]:
@@ -321,11 +605,12 @@ idx = 0
 # Loop through a list of the three top unicorn investors
 for c in ['Sequoia Capital', 'Tiger Global Management','Accel']:
     
-    # Compute the number of companies invested in in each industry by c
-    companies_sample = companies[companies[c] == 1]
+    # Look up the number of companies invested in in each industry by c
+    companies_sample = big_3_aggregates['industry']
+    companies_sample = companies_sample[companies_sample['Investor'] == c]
     
     # Calculate the distribution of Industry
-    companies_sample = companies_sample['Industry'].value_counts()
+    companies_sample = companies_sample.set_index('Industry')['Companies'].sort_values(ascending=False)
 
     # Create a bar plot
     sns.barplot(
@@ -381,11 +666,12 @@ idx = 0
 # Loop through a list of the three top unicorn investors
 for c in ['Sequoia Capital', 'Tiger Global Management', 'Accel']:
     
-    # Compute the number of companies invested in in each industry by c
-    companies_sample = companies[companies[c] == 1]
+    # Look up the number of companies invested in in each continent by c
+    companies_sample = big_3_aggregates['continent']
+    companies_sample = companies_sample[companies_sample['Investor'] == c]
     
     # Calculate the distribution of Continent
-    companies_sample = companies_sample['Continent'].value_counts()
+    companies_sample = companies_sample.set_index('Continent')['Companies']
     
     # Add Oceania as index with value 0 if not present in companies_sample
     if 'Oceania' not in companies_sample.index:
@@ -429,10 +715,43 @@ plt.suptitle('Location of Investments by Largest Unicorn Investors', fontsize =
 # 
 # Sequoia Capital is the only investor that invested in a unicorn company in Africa. Accel is the only investor to not have any unicorn company investments in Oceania.
 
+# ### Render the investor charts in batch
+# 
+# The plots above need an interactive backend and are redrawn from the data on every run. For batch jobs over many investors, `render_investor_charts` draws one industry chart and one continent chart per investor straight from the tables of `investor_aggregates`. Each chart is drawn on a standalone `Figure` with the Agg renderer (no pyplot state or display), and `matplotlib` and `seaborn` are only imported when a chart actually has to be drawn.
+# 
+# Every chart file is named after a fingerprint of the counts it shows, so a chart whose data did not change is found on disk and not drawn again, and the file of a chart whose data changed is deleted. The charts that are missing are drawn in a pool of processes. As in the plots above, every continent chart uses the same y axis from 0 to 80.
+
+# In[ ]:
+
+
+# Render the per-investor charts headlessly, with a cache keyed on the data.
+
+
+# Set to True to render the charts of the Big 3 investors into the charts directory
+run_chart_rendering = False
+
+if run_chart_rendering:
+    print('Rendered charts:')
+    print(render_investor_charts(big_3_aggregates, continent_ylim=(0, 80)))
+
+
 # ## Step 4: Results and evaluation
 
 # Your client wants to know if there are particular investment strategies for the three large unicorn investors: Sequoia Capital, Tiger Global Management, and Accel. Therefore, consider how you would present your findings and whether the business will find that information insightful.
 
+# ### Build an investor index
+# 
+# Each question below used to filter the whole frame with a boolean mask (and the top 3 question sorted the whole frame first). The investor index stores, for every investor in `Select Investors`, the list of rows of the companies they invested in, already ordered by descending `Valuation`. Portfolio lookups, top-k by `Valuation` and co-investments then only touch the rows of the portfolios involved, not the whole dataset.
+
+# In[ ]:
+
+
+# Build an index from each investor to the companies they invested in.
+
+
+investor_index = InvestorIndex(companies)
+
+
 # ### Calculate the average `Years to Unicorn` 
 
 # In[ ]:
@@ -442,7 +761,7 @@ plt.suptitle('Location of Investments by Largest Unicorn Investors', fontsize =
 
 
 print('Mean Years to Unicorn for Sequoia Capital:')
-print(companies[companies['Sequoia Capital']==1]['Years To Unicorn'].mean())
+print(investor_index.mean('Sequoia Capital'))
 
 
 # Compute the mean Years to Unicorn for unicorn companies invested in by Tiger Global Management.
@@ -450,7 +769,7 @@ print(companies[companies['Sequoia Capital']==1]['Years To Unicorn'].mean())
 
 
 print('Mean Years to Unicorn for Tiger Global Management:')
-print(companies[companies['Tiger Global Management']==1]['Years To Unicorn'].mean())
+print(investor_index.mean('Tiger Global Management'))
 
 
 # Compute the mean Years to Unicorn for unicorn companies invested in by Accel.
@@ -458,7 +777,7 @@ print(companies[companies['Tiger Global Management']==1]['Years To Unicorn'].mea
  
 
 print('Mean Years to Unicorn for Accel:')
-print(companies[companies['Accel']==1]['Years To Unicorn'].mean())
+print(investor_index.mean('Accel'))
 
 
 # **Question: Of the three top unicorn investors, which has the shortest average `Years to Unicorn`?**
@@ -470,11 +789,7 @@ print(companies[companies['Accel']==1]['Years To Unicorn'].mean())
 # In[ ]:
 
 
-# Sort companies by Valuation in descending order
-
-
-
-companies = companies.sort_values(by = 'Valuation', ascending=False)
+# The investor index already orders each portfolio by descending Valuation, so the whole frame does not need to be sorted.
 
 
 # Calculate the 3 companies with the highest valuation invested in by Sequoia Capital.
@@ -482,7 +797,7 @@ companies = companies.sort_values(by = 'Valuation', ascending=False)
 
 print('Highest valued unicorns invested in by Sequoia Capital:')
 
-print(companies[companies['Sequoia Capital']==1]['Company'].values[:3])
+print(investor_index.top_k('Sequoia Capital', 3))
 
 
 # Calculate the 3 companies with the highest valuation invested in by Tiger Global Management.
@@ -491,7 +806,7 @@ print(companies[companies['Sequoia Capital']==1]['Company'].values[:3])
 
 print('Highest valued unicorns invested in by Tiger Global Management:')
 
-print(companies[companies['Tiger Global Management']==1]['Company'].values[:3])
+print(investor_index.top_k('Tiger Global Management', 3))
 
 
 # Calculate the 3 companies with the highest valuation invested in by Accel.
@@ -500,7 +815,7 @@ print(companies[companies['Tiger Global Management']==1]['Company'].values[:3])
 
 print('Highest valued unicorns invested in by Accel:')
 
-print(companies[companies['Accel']==1]['Company'].values[:3])
+print(investor_index.top_k('Accel', 3))
 
 
 # **Question: What are the three companies with the highest `Valuation` invested in by each of the top three unicorn investors?**
@@ -522,11 +837,13 @@ print(companies[companies['Accel']==1]['Company'].values[:3])
 # Create a new column that counts the number of investments by the top three unicorn investors
 companies['Big 3 Investors'] = companies['Sequoia Capital'] + companies['Tiger Global Management'] + companies['Accel']
 
-# Create a new DataFrame that only includes companies with 2 or more investments by the top three unicorn investors
-top_companies = companies[companies['Big 3 Investors'] >= 2]
+# Create a new DataFrame that only includes companies with 2 or more investments by the top three unicorn investors,
+# highest Valuation first (companies is no longer sorted, so the order comes from investor_index)
+companies_by_valuation = companies.iloc[investor_index.order]
+top_companies = companies_by_valuation[companies_by_valuation['Big 3 Investors'] >= 2]
 
 # Create a list of the companies in top_companies
-top_companies_list = companies[companies['Big 3 Investors'] >= 2]['Company'].values
+top_companies_list = top_companies['Company'].values
 
 # Display the results
 print('Number of unicorns with two or more of the Big 3 Investors: ')
@@ -540,6 +857,57 @@ print(top_companies_list)
 # 
 # There are 18 companies invested in by two of three unicorn investment firms at any given time: SHEIN, Getir, and Razorpay.
 
+# ### Co-investment across all investors
+# 
+# The `Big 3 Investors` column only answers the question for three hard-coded investors. The functions in `unicorn_pipeline.py` answer it for every investor in `Select Investors` at once, using the company x investor matrix from `investor_matrix`:
+# 
+# * `co_investment_pairs` multiplies the matrix by its transpose to count the companies shared by every pair of investors, adds the Jaccard similarity (shared companies divided by the companies backed by either investor) and keeps the top pairs.
+# * `co_investment_groups` counts the companies shared by every group of k investors. Companies are grouped by how many investors they list, and all the k-combinations of a group are generated with array indexing instead of a loop over companies.
+
+# In[ ]:
+
+
+# Compute co-investment overlaps between all investors.
+
+
+# Display the investor pairs and triples that most often invest together
+investors_matrix, investors_vocabulary = investor_matrix(companies)
+
+print('Investor pairs with the most companies in common:')
+print(co_investment_pairs(investors_matrix, investors_vocabulary, top_n=10))
+
+print('Investor triples with the most companies in common:')
+print(co_investment_groups(investors_matrix, investors_vocabulary, k=3, top_n=10))
+
+
+# ### Answer questions with the query service
+# 
+# Questions like the ones above used to be answered by running the notebook again. `QueryService` keeps one copy of the cleaned `companies` frame in memory and answers batches of queries: filters by investor, industry and continent (or by a minimum number of investors from a list), followed by an aggregate or the top rows by `Valuation`. Results are kept in an LRU cache that is emptied when a new version of the data is loaded.
+# 
+# `python unicorn_pipeline.py serve Modified_Unicorn_Companies.csv` runs the same service on a local port with asyncio, for dashboards to send queries as lines of JSON (see `request_queries`). It checks the file every few seconds and reloads it when its version (the hash of the file and of the cleaning rules) changes.
+
+# In[ ]:
+
+
+# Answer a batch of questions from one resident copy of the data.
+
+
+query_service = QueryService(companies)
+
+top_3_queries = [{'investor': investor, 'top': 3, 'columns': ['Company']} for investor in big_3_investors]
+mean_queries = [{'investor': investor, 'aggregate': {'func': 'mean', 'column': 'Years To Unicorn'}}
+                for investor in big_3_investors]
+overlap_query = {'min_investors': {'investors': big_3_investors, 'min': 2}, 'aggregate': {'func': 'count'}}
+
+big_3_answers = query_service.run(top_3_queries + mean_queries + [overlap_query])
+
+for investor, top, mean in zip(big_3_investors, big_3_answers[:3], big_3_answers[3:6]):
+    print(investor, [row['Company'] for row in top], round(mean, 1))
+
+print('Number of unicorns with two or more of the Big 3 Investors: ')
+print(big_3_answers[6])
+
+
 # ## Conclusion
 # 
 # **What are some key takeaways that you learned during this lab?**
@@ -0,0 +1,2517 @@
+"""Cleaning, validation and investor analysis of the unicorn companies data.
+
+The steps of the notebook export ``companies data validation and cleaning using python.py``
+as importable functions. Only numpy and pandas are imported with the module; scipy,
+pyarrow, matplotlib, seaborn and polars are imported by the functions that need them.
+
+Run ``python unicorn_pipeline.py --help`` for the command line interface.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import difflib
+import functools
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, count
+
+import numpy as np
+import pandas as pd
+
+
+# ## Instrumentation
+
+# Callables that receive one record per instrumented stage call; stages are not measured when empty
+stage_hooks = []
+
+# Extra measurements per stage, off by default because they slow the stages down
+stage_options = {'rows_modified': False, 'trace_memory': False, 'profile_dir': None}
+
+# Name of the stage being measured; stages called inside it are counted in it
+_running_stage = None
+_stage_calls = count()
+
+
+class JsonLinesExporter:
+    """Stage hook that appends every record as one line of JSON to path.
+
+    Any keyword arguments (e.g. run='nightly') are added to every record.
+    """
+
+    def __init__(self, path, **fields):
+        self.path = path
+        self.fields = fields
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({**self.fields, **record}) + '\n')
+
+
+@contextlib.contextmanager
+def instrument(*hooks, rows_modified=False, trace_memory=False, profile_dir=None):
+    """Send the records of every stage run inside the with block to hooks.
+
+    rows_modified compares each input frame with a copy taken before the stage, and
+    profile_dir saves a cProfile file of every stage call into that directory.
+
+    memory_delta_bytes is the peak memory of the stage above what was in use when it started.
+    By default it is the peak resident size, which is reset before every stage through
+    /proc/self/clear_refs; where that is not available it is only the change of the resident
+    size, and memory_source says which one was measured. trace_memory measures the peak
+    traced by tracemalloc instead. A stage that raises is recorded with its error.
+    """
+
+    saved = dict(stage_options)
+    stage_options.update(rows_modified=rows_modified, trace_memory=trace_memory, profile_dir=profile_dir)
+    stage_hooks.extend(hooks)
+
+    try:
+        yield
+    finally:
+        for hook in hooks:
+            stage_hooks.remove(hook)
+        stage_options.update(saved)
+
+
+def _current_rss():
+    """Return the current resident size of the process in bytes, or None where it is not available."""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """Reset the peak resident size of the process (Linux only); return whether it worked."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Return the peak resident size of the process since the last reset in bytes, or None."""
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _rows_modified(before, after):
+    """Return the number of rows of after with a changed value in a column that before already had."""
+
+    if not isinstance(after, pd.DataFrame) or not before.index.is_unique or not after.index.is_unique:
+        return None
+
+    rows = after.index.intersection(before.index)
+    columns = after.columns.intersection(before.columns)
+    old = before.loc[rows, columns].astype(object)
+    new = after.loc[rows, columns].astype(object)
+
+    # A value parsed into another type (e.g. a date string into a Timestamp) counts as changed
+    changed = (old != new) & ~(old.isna() & new.isna())
+    return int(changed.any(axis=1).sum())
+
+
+def _run_stage(stage, func, args, kwargs):
+    """Call func as the stage named stage and send its record to stage_hooks."""
+
+    global _running_stage
+
+    frame = args[0] if args and isinstance(args[0], pd.DataFrame) else None
+    before = frame.copy() if frame is not None and stage_options['rows_modified'] else None
+
+    # Memory of the stage: the peak above the start, traced by tracemalloc or of the resident
+    # size; where the resident peak cannot be reset, the change of the resident size
+    stop_tracing = False
+    if stage_options['trace_memory']:
+        stop_tracing = not tracemalloc.is_tracing()
+        if stop_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_source = 'tracemalloc peak'
+        memory = tracemalloc.get_traced_memory()[0]
+    else:
+        memory_source = 'rss peak' if _reset_peak_rss() else 'rss change'
+        memory = _current_rss()
+
+    profiler = cProfile.Profile() if stage_options['profile_dir'] else None
+
+    started = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    _running_stage = stage
+    result = error = None
+    try:
+        result = profiler.runcall(func, *args, **kwargs) if profiler else func(*args, **kwargs)
+    except StopIteration:
+        # An exhausted chunk reader (see _load_chunks): no stage ran, so nothing is recorded
+        error = StopIteration
+        raise
+    except BaseException as exc:
+        error = f'{type(exc).__name__}: {exc}'
+        raise
+    finally:
+        _running_stage = None
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        if stage_options['trace_memory']:
+            memory = tracemalloc.get_traced_memory()[1] - memory
+            if stop_tracing:
+                tracemalloc.stop()
+        elif memory is not None:
+            after = _peak_rss() if memory_source == 'rss peak' else _current_rss()
+            memory = after - memory if after is not None else None
+
+        if error is not StopIteration:
+            _send_record(stage, started, wall, cpu, memory, memory_source, frame, before, result, error, profiler)
+
+    return result
+
+
+def _send_record(stage, started, wall, cpu, memory, memory_source, frame, before, result, error, profiler):
+    """Build the record of one stage call, save its profile and send it to stage_hooks."""
+
+    record = {'stage': stage,
+              'started': started,
+              'wall_seconds': wall,
+              'cpu_seconds': cpu,
+              'memory_delta_bytes': memory,
+              'memory_source': memory_source,
+              'rows_in': len(frame) if frame is not None else None,
+              'rows_out': len(result) if isinstance(result, pd.DataFrame) else None,
+              'rows_modified': _rows_modified(before, result) if before is not None and error is None else None,
+              'error': error}
+
+    if profiler:
+        os.makedirs(stage_options['profile_dir'], exist_ok=True)
+        record['profile'] = os.path.join(stage_options['profile_dir'],
+                                         f'{stage}-{os.getpid()}-{next(_stage_calls)}.prof')
+        profiler.dump_stats(record['profile'])
+
+    for hook in stage_hooks:
+        hook(record)
+
+
+def instrumented(stage):
+    """Decorate a pipeline stage so that its calls are measured while stage_hooks is not empty.
+
+    The stage takes a frame as its first argument; rows_in, rows_out and rows_modified are
+    only filled in for frames.
+    """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not stage_hooks or _running_stage is not None:
+                return func(*args, **kwargs)
+            return _run_stage(stage, func, args, kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# ## Loading
+
+# Declared data types for every column, so read_csv does not have to infer them
+companies_dtypes = {'Company': str,
+                    'Valuation': 'int32',
+                    'Date Joined': 'category',
+                    'Industry': 'category',
+                    'City': str,
+                    'Country/Region': 'category',
+                    'Continent': 'category',
+                    'Year Founded': 'int16',
+                    'Funding': str,
+                    'Select Investors': str}
+
+# Date Joined is parsed with a fixed format instead of guessing it row by row
+date_joined_format = '%Y-%m-%d'
+
+# Date strings that could not be parsed with errors='collect', string -> number of rows
+date_parse_errors = {}
+
+
+def parse_dates(values, format=date_joined_format, strict=True, errors='raise'):
+    """Return the Series values converted to datetime, parsing each distinct string once.
+
+    With strict=False strings that do not match format are parsed by inferring their format.
+    errors='raise' fails on the first string that cannot be parsed, 'coerce' turns it into
+    NaT, and 'collect' does the same and counts it in date_parse_errors.
+    """
+
+    if errors not in ('raise', 'coerce', 'collect'):
+        raise ValueError(f"errors must be 'raise', 'coerce' or 'collect', not {errors!r}")
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    # Date Joined has a few thousand distinct strings even on millions of rows
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques).astype(str)
+
+    parsed = pd.to_datetime(uniques, format=format, errors='raise' if strict and errors == 'raise' else 'coerce')
+
+    if not strict:
+        retry = parsed.isna()
+        if retry.any():
+            fallback = pd.to_datetime(uniques[retry], format='mixed', errors='raise' if errors == 'raise' else 'coerce')
+            dates = parsed.to_numpy().copy()
+            dates[retry] = pd.DatetimeIndex(fallback).as_unit(parsed.unit).to_numpy()
+            parsed = pd.DatetimeIndex(dates)
+
+    if errors == 'collect':
+        failed = np.flatnonzero(parsed.isna())
+        if len(failed):
+            rows = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            for i in failed:
+                date_parse_errors[uniques[i]] = date_parse_errors.get(uniques[i], 0) + int(rows[i])
+
+    # Broadcast the parsed dates to the rows through the codes, missing strings become NaT
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index, name=values.name)
+
+
+@instrumented('load')
+def _load(read, date_errors='raise'):
+    """Return the frame returned by read() with Date Joined parsed."""
+
+    frame = read()
+    if 'Date Joined' in frame:
+        frame['Date Joined'] = parse_dates(frame['Date Joined'], errors=date_errors)
+
+    return frame
+
+
+def _load_chunks(reader, date_errors='raise'):
+    """Yield the chunks of reader, each loaded (and measured) as it is read."""
+
+    with reader:
+        while True:
+            try:
+                chunk = _load(lambda: next(reader), date_errors)
+            except StopIteration:
+                return
+            yield chunk
+
+
+def read_companies(path, engine='c', usecols=None, date_errors='raise', **kwargs):
+    """Read the companies file with the declared schema applied at parse time.
+
+    engine can be 'c' or 'pyarrow' (pyarrow does not support chunksize). usecols limits
+    parsing to the listed columns. Date Joined is read as a category and parsed once per
+    distinct string, with date_errors passed to parse_dates.
+    """
+
+    # Only declare types for the columns that are read
+    dtypes = {col: dtype for col, dtype in companies_dtypes.items() if usecols is None or col in usecols}
+
+    def read():
+        return pd.read_csv(path, engine=engine, usecols=usecols, dtype=dtypes, **kwargs)
+
+    # With chunksize every chunk is read, parsed and measured as a separate load
+    if kwargs.get('chunksize'):
+        return _load_chunks(read(), date_errors)
+
+    return _load(read, date_errors)
+
+
+def benchmark_load(path, repeats=3):
+    """Return a DataFrame with the best load time and frame size of each loader."""
+
+    analysis_cols = ['Company', 'Valuation', 'Date Joined', 'Industry', 'Continent', 'Year Founded', 'Select Investors']
+
+    def inferred():
+        frame = pd.read_csv(path)
+        frame['Date Joined'] = pd.to_datetime(frame['Date Joined'])
+        return frame
+
+    loaders = {'inferred': inferred,
+               'schema (c)': lambda: read_companies(path, engine='c'),
+               'schema (pyarrow)': lambda: read_companies(path, engine='pyarrow'),
+               'schema + usecols (pyarrow)': lambda: read_companies(path, engine='pyarrow', usecols=analysis_cols)}
+
+    results = []
+    for name, loader in loaders.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            frame = loader()
+            times.append(time.perf_counter() - start)
+        results.append({'loader': name,
+                        'seconds': min(times),
+                        'megabytes': frame.memory_usage(deep=True).sum() / 1024 ** 2})
+
+    results = pd.DataFrame(results).set_index('loader')
+
+    # Express each loader relative to the inferred baseline
+    results['speedup'] = results.loc['inferred', 'seconds'] / results['seconds']
+    results['memory ratio'] = results.loc['inferred', 'megabytes'] / results['megabytes']
+
+    return results
+
+
+# ## Cleaning rules
+
+# Manual Year Founded corrections (InVision's 2011 was determined from an internet search)
+year_founded_fixes = {'InVision': 2011}
+
+# List provided by the company of the expected industry labels in the data
+industry_list = ['Artificial intelligence', 'Other', 'E-commerce & direct-to-consumer', 'Fintech',
+                 'Internet software & services', 'Supply chain, logistics, & delivery', 'Consumer & retail',
+                 'Data management & analytics', 'Edtech', 'Health', 'Hardware', 'Auto & transportation',
+                 'Travel', 'Cybersecurity', 'Mobile & telecommunications']
+
+# Define a dictionary that maps the incorrect industry spellings to their correct industry spelling
+industry_dct = {'Artificial Intelligence':'Artificial intelligence',
+                'Data management and analytics':'Data management & analytics',
+                'FinTech':'Fintech'}
+
+
+# ## Industry normalization
+
+# Minimum similarity for a label to be mapped automatically
+industry_match_threshold = 0.85
+
+# Resolved matches, raw label -> (label, score)
+industry_matches = {}
+
+# Labels that scored below the threshold, raw label -> (best label, score)
+industry_review_queue = {}
+
+# Matches read by load_industry_matches, which can differ from what match_industry would give
+loaded_industry_matches = {}
+
+
+def _industry_key(label):
+    """Return label case-folded, single-spaced and with 'and' written as '&'."""
+
+    return ' '.join(str(label).casefold().replace(' and ', ' & ').split())
+
+
+def match_industry(label, choices=industry_list):
+    """Return the closest label in choices and its similarity score between 0 and 1."""
+
+    if label in industry_dct:
+        return industry_dct[label], 1.0
+
+    keys = {_industry_key(choice): choice for choice in choices}
+    key = _industry_key(label)
+    if key in keys:
+        return keys[key], 1.0
+
+    scores = {choice_key: difflib.SequenceMatcher(None, key, choice_key).ratio() for choice_key in keys}
+    best = max(scores, key=scores.get)
+
+    return keys[best], scores[best]
+
+
+def industry_mapping(labels, threshold=None):
+    """Return a dict mapping each of the distinct labels onto industry_list.
+
+    Labels scoring below threshold keep their value and are added to industry_review_queue.
+    """
+
+    threshold = industry_match_threshold if threshold is None else threshold
+
+    # Match only the labels that were not seen before
+    mapping = {}
+    for label in labels:
+        if label not in industry_matches:
+            industry_matches[label] = match_industry(label)
+        match, score = industry_matches[label]
+        if score >= threshold:
+            mapping[label] = match
+        else:
+            mapping[label] = label
+            industry_review_queue[label] = (match, score)
+
+    return mapping
+
+
+def normalize_industry(industry, threshold=None):
+    """Return the Industry Series with every distinct label mapped onto industry_list."""
+
+    industry = industry.astype('category')
+    mapping = industry_mapping(industry.cat.categories, threshold)
+
+    # Broadcast the mapping to the rows through the category codes
+    labels = pd.Index([mapping[label] for label in industry.cat.categories])
+    categories = pd.Index(sorted(labels.unique()))
+    codes = categories.get_indexer(labels)
+
+    # Missing values have code -1, which picks the -1 appended at the end
+    codes = np.append(codes, -1)[industry.cat.codes]
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories).remove_unused_categories(),
+                     index=industry.index, name=industry.name)
+
+
+def save_industry_matches(path):
+    """Write the memoized industry matches to a JSON file."""
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump({label: list(match) for label, match in industry_matches.items()}, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_industry_matches(path):
+    """Add the industry matches saved by save_industry_matches to the memo.
+
+    Saved matches scoring below industry_match_threshold are still waiting for review, so
+    they are added to industry_review_queue again.
+    """
+
+    with open(path) as f:
+        matches = {label: tuple(match) for label, match in json.load(f).items()}
+
+    industry_matches.update(matches)
+    loaded_industry_matches.update(matches)
+    industry_review_queue.update({label: match for label, match in matches.items()
+                                  if match[1] < industry_match_threshold})
+
+
+def industry_review_table():
+    """Return industry_review_queue as a DataFrame of label, best match and score, lowest score first."""
+
+    rows = [(label, match, score) for label, (match, score) in industry_review_queue.items()]
+    table = pd.DataFrame(rows, columns=['label', 'best match', 'score'])
+
+    return table.sort_values('score', kind='stable').reset_index(drop=True)
+
+
+# ## Investors
+
+# The top three unicorn investors
+big_3_investors = ['Sequoia Capital', 'Tiger Global Management', 'Accel']
+
+
+def normalize_investors(names):
+    """Return the investor names in the Series names trimmed, single-spaced and case-folded."""
+
+    return names.str.strip().str.replace(r'\s+', ' ', regex=True).str.casefold()
+
+
+def investor_matrix(frame):
+    """Return a sparse 0/1 matrix of companies x investors and the normalized investor names of its columns."""
+
+    from scipy import sparse
+
+    # One row per (company position, investor name) pair
+    investors = pd.Series(frame['Select Investors'].fillna('').to_numpy(), dtype=str).str.split(',').explode()
+    names = normalize_investors(investors.astype(str))
+
+    # Drop empty names left by missing values or trailing commas
+    names = names[names != '']
+    codes, vocabulary = pd.factorize(names, sort=True)
+
+    matrix = sparse.csr_matrix((np.ones(len(codes), dtype=np.int8), (names.index.to_numpy(), codes)),
+                               shape=(len(frame), len(vocabulary)))
+
+    # An investor listed twice for the same company still counts once
+    matrix.data[:] = 1
+
+    return matrix, pd.Index(vocabulary)
+
+
+@instrumented('investor_flags')
+def flag_investors(frame, investors=big_3_investors):
+    """Add a dummy variable to frame for each investor in investors, matched by exact name."""
+
+    # Nothing to flag, so skip tokenizing Select Investors
+    if not len(investors):
+        return frame
+
+    matrix, vocabulary = investor_matrix(frame)
+    columns = vocabulary.get_indexer(normalize_investors(pd.Series(investors, dtype=str)))
+
+    # Investors that never appear get a column of zeros
+    flags = np.zeros((len(frame), len(investors)), dtype=int)
+    found = columns >= 0
+    flags[:, found] = matrix[:, columns[found]].toarray()
+
+    for i, investor in enumerate(investors):
+        frame[investor] = flags[:, i]
+
+    return frame
+
+
+# ## Row cleaning and streaming
+
+# Memory budget for one chunk, used when no row count is given
+stream_byte_budget = 64 * 1024 ** 2
+
+
+def rows_for_budget(path, byte_budget, sample_rows=1000):
+    """Estimate how many rows of the file fit in byte_budget once loaded."""
+
+    # Measure the in-memory size of a sample of the file
+    sample = read_companies(path, nrows=sample_rows)
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+
+    return max(1, int(byte_budget // bytes_per_row))
+
+
+@instrumented('parse_dates')
+def parse_date_joined(frame, strict=True, errors='raise'):
+    """Convert Date Joined to datetime with parse_dates."""
+
+    frame['Date Joined'] = parse_dates(frame['Date Joined'], date_joined_format, strict, errors)
+
+    return frame
+
+
+@instrumented('year_founded_fixes')
+def fix_year_founded(frame):
+    """Apply the manual Year Founded corrections.
+
+    When frame already has Years To Unicorn it is recomputed for the corrected rows only.
+    """
+
+    corrected = frame['Company'].isin(list(year_founded_fixes)).to_numpy()
+    if not corrected.any():
+        return frame
+
+    years = frame.loc[corrected, 'Company'].map(year_founded_fixes).astype(frame['Year Founded'].dtype)
+    frame.loc[corrected, 'Year Founded'] = years
+
+    if 'Years To Unicorn' in frame:
+        frame.loc[corrected, 'Years To Unicorn'] = frame.loc[corrected, 'Date Joined'].dt.year - years
+
+    return frame
+
+
+@instrumented('years_to_unicorn')
+def add_years_to_unicorn(frame):
+    """Calculate Years To Unicorn with the corrected Year Founded."""
+
+    frame['Years To Unicorn'] = frame['Date Joined'].dt.year - frame['Year Founded']
+
+    return frame
+
+
+@instrumented('industry_normalization')
+def relabel_industry(frame):
+    """Map the industry labels onto industry_list."""
+
+    frame['Industry'] = normalize_industry(frame['Industry'])
+
+    return frame
+
+
+@instrumented('dedup')
+def drop_duplicate_companies(frame):
+    """Keep the first row of each Company."""
+
+    return frame.drop_duplicates(subset=['Company'])
+
+
+def clean_chunk(chunk, investors=big_3_investors):
+    """Apply the row-level cleaning steps to one chunk of the companies data."""
+
+    chunk = parse_date_joined(chunk)
+    chunk = fix_year_founded(chunk)
+    chunk = add_years_to_unicorn(chunk)
+    chunk = relabel_industry(chunk)
+
+    return flag_investors(chunk, investors)
+
+
+def in_seen(values, seen):
+    """Return a boolean array telling which of values are in the set seen.
+
+    Costs one hash lookup per value, where Series.isin would copy the whole set every call.
+    """
+
+    return np.fromiter((value in seen for value in values), dtype=bool, count=len(values))
+
+
+def iter_clean_chunks(path, chunk_rows=None, byte_budget=stream_byte_budget, drop_duplicates=True, encoders=None):
+    """Yield cleaned chunks of the file at path, keeping the first row of each Company.
+
+    With fitted encoders the Continent, Country/Region and Industry encodings are added to
+    every chunk, so all chunks get the same codes and dummy columns.
+    """
+
+    # Work out the chunk size from the byte budget if no row count is given
+    if chunk_rows is None:
+        chunk_rows = rows_for_budget(path, byte_budget)
+
+    # Companies already yielded in an earlier chunk
+    seen_companies = set()
+
+    for chunk in read_companies(path, chunksize=chunk_rows):
+        chunk = clean_chunk(chunk)
+
+        if drop_duplicates:
+            # Drop duplicates inside the chunk and against the earlier chunks
+            chunk = chunk[~chunk['Company'].duplicated().to_numpy() & ~in_seen(chunk['Company'], seen_companies)]
+            seen_companies.update(chunk['Company'])
+
+        if encoders is not None:
+            chunk = encode_categories(chunk, encoders)
+
+        yield chunk
+
+
+def clean_companies_streaming(path, out_path, chunk_rows=None, byte_budget=stream_byte_budget, encoders=None):
+    """Clean the file at path chunk by chunk into out_path and return the number of rows written."""
+
+    rows_out = 0
+
+    # Chunks are written as they are cleaned so only one is held in memory
+    for i, chunk in enumerate(iter_clean_chunks(path, chunk_rows, byte_budget, encoders=encoders)):
+        chunk.to_csv(out_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        rows_out += len(chunk)
+
+    return rows_out
+
+
+# ## Validation
+
+validation_rules = [
+    {'name': 'non-negative Years To Unicorn', 'type': 'range', 'column': 'Years To Unicorn', 'min': 0},
+    {'name': 'expected industry label', 'type': 'allowed', 'column': 'Industry', 'values': industry_list},
+    {'name': 'unique company', 'type': 'unique', 'column': 'Company'},
+    {'name': 'founded before joining', 'type': 'check', 'expression': '`Year Founded` <= `Date Joined`.dt.year'},
+    {'name': 'corrected Year Founded', 'type': 'override', 'key': 'Company', 'column': 'Year Founded',
+     'values': year_founded_fixes},
+]
+
+
+def compile_rules(rules):
+    """Return a list of (rule, check) pairs where check(frame, seen) returns a mask of violating rows."""
+
+    def range_check(rule):
+        def check(frame, seen):
+            values = frame[rule['column']]
+            bad = pd.Series(False, index=frame.index)
+            if 'min' in rule:
+                bad |= values < rule['min']
+            if 'max' in rule:
+                bad |= values > rule['max']
+            return bad
+        return check
+
+    def allowed_check(rule):
+        allowed = pd.Index(rule['values'])
+        return lambda frame, seen: ~frame[rule['column']].isin(allowed) & frame[rule['column']].notna()
+
+    def unique_check(rule):
+        def check(frame, seen):
+            values = frame[rule['column']]
+            bad = values.duplicated().to_numpy() | in_seen(values, seen)
+            seen.update(values[~bad])
+            return pd.Series(bad, index=frame.index)
+        return check
+
+    def expression_check(rule):
+        return lambda frame, seen: ~frame.eval(rule['expression'], engine='python').astype(bool)
+
+    def override_check(rule):
+        expected = pd.Series(rule['values'])
+        def check(frame, seen):
+            wanted = frame[rule['key']].map(expected)
+            return wanted.notna() & (frame[rule['column']] != wanted)
+        return check
+
+    builders = {'range': range_check, 'allowed': allowed_check, 'unique': unique_check,
+                'check': expression_check, 'override': override_check}
+
+    return [(rule, builders[rule['type']](rule)) for rule in rules]
+
+
+def validate(frame, rules=validation_rules, seen=None, compiled=None):
+    """Return a DataFrame with one row (rule, row id, column, value) per violation in frame."""
+
+    compiled = compiled or compile_rules(rules)
+    seen = seen if seen is not None else {rule['name']: set() for rule, _ in compiled}
+
+    reports = []
+    for rule, check in compiled:
+        bad = check(frame, seen[rule['name']]).to_numpy()
+        column = rule.get('column')
+        reports.append(pd.DataFrame({'rule': rule['name'],
+                                     'row': frame.index[bad],
+                                     'column': column,
+                                     'value': frame[column][bad].astype(object) if column else None}))
+
+    return pd.concat(reports, ignore_index=True)
+
+
+def validate_chunks(chunks, rules=validation_rules):
+    """Return the violations report for a stream of chunks, checking uniqueness across chunks."""
+
+    compiled = compile_rules(rules)
+    seen = {rule['name']: set() for rule, _ in compiled}
+
+    return pd.concat([validate(chunk, rules, seen, compiled) for chunk in chunks], ignore_index=True)
+
+
+# ## Encoding
+
+class CategoryEncoder:
+    """Label and one hot encoder for one column with a fixed, sorted vocabulary."""
+
+    def __init__(self, categories=(), unknown='error'):
+        self.categories = sorted(categories)
+        self.unknown = unknown
+
+    def fit(self, values):
+        """Set the vocabulary to the distinct non-missing values and return the encoder."""
+
+        self.categories = sorted(pd.Series(values).dropna().unique())
+        return self
+
+    def _categorical(self, values):
+        """Return values as a Categorical over the vocabulary, applying the unknown policy."""
+
+        values = pd.Series(values)
+
+        # Unknown values get code -1 like missing ones; pd.Categorical warns about them
+        codes = pd.Index(self.categories).get_indexer(values)
+
+        if self.unknown == 'error':
+            unknown = values.notna().to_numpy() & (codes == -1)
+            if unknown.any():
+                raise ValueError(f'Unknown categories: {sorted(values[unknown].unique())}')
+
+        return pd.Categorical.from_codes(codes, categories=self.categories)
+
+    def codes(self, values):
+        """Return the int8/int16 code of each value in the vocabulary (-1 for missing or unknown)."""
+
+        return self._categorical(values).codes
+
+    def dummies(self, values, drop_first=True, sparse=False):
+        """Return a DataFrame of 0/1 uint8 columns, one per category of the vocabulary."""
+
+        encoded = pd.get_dummies(self._categorical(values), drop_first=drop_first, sparse=sparse, dtype=np.uint8)
+        encoded.index = values.index if isinstance(values, pd.Series) else encoded.index
+
+        return encoded
+
+    def to_dict(self):
+        return {'categories': [str(category) for category in self.categories], 'unknown': self.unknown}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['categories'], state['unknown'])
+
+
+def fit_encoders(frame):
+    """Fit the Continent, Country/Region and Industry encoders on frame."""
+
+    return {'Continent': CategoryEncoder().fit(frame['Continent']),
+            'Country/Region': CategoryEncoder().fit(frame['Country/Region']),
+            # Labels waiting in industry_review_queue get no dummy column instead of failing
+            'Industry': CategoryEncoder(industry_list, unknown='ignore')}
+
+
+def save_encoders(encoders, path):
+    """Write the encoders to a JSON file."""
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump({column: encoder.to_dict() for column, encoder in encoders.items()}, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_encoders(path):
+    """Read encoders written by save_encoders."""
+
+    with open(path) as f:
+        return {column: CategoryEncoder.from_dict(state) for column, state in json.load(f).items()}
+
+
+@instrumented('encodings')
+def encode_categories(frame, encoders):
+    """Add the Continent, Country/Region and Industry encodings to frame using fitted encoders."""
+
+    frame = pd.concat([frame, encoders['Continent'].dummies(frame['Continent'], drop_first = True)], axis=1)
+    frame['Country/Region'] = encoders['Country/Region'].codes(frame['Country/Region'])
+    frame = pd.concat([frame, encoders['Industry'].dummies(frame['Industry'], drop_first = True)], axis=1)
+
+    return frame
+
+
+@instrumented('encodings')
+def encode_companies(frame, encoders=None):
+    """Add the High Valuation, Continent, Country/Region and Industry encodings to frame.
+
+    The encoders are fitted on frame when none are given.
+    """
+
+    frame['High Valuation'] = pd.qcut(frame['Valuation'], 2, labels = ['No','Yes']).cat.codes
+
+    return encode_categories(frame, encoders or fit_encoders(frame))
+
+
+def clean_companies(frame, encoders=None):
+    """Run every cleaning and encoding step on a freshly loaded companies frame."""
+
+    # The investor flags are added last to keep the column order of the notebook
+    frame = clean_chunk(frame, investors=[])
+    frame = drop_duplicate_companies(frame)
+    frame = encode_companies(frame, encoders)
+
+    return flag_investors(frame)
+
+
+# ## Streaming quantiles
+
+class QuantileSketch:
+    """Mergeable KLL-style quantile sketch of a numeric column.
+
+    Values are kept in levels, where a value at level h stands for 2**h values. When a level
+    grows past its capacity it is sorted and every other value moves up one level, which
+    keeps memory at roughly 3 * k values however many are added. Every such compaction at
+    level h can shift any rank by at most 2**h, and `rank_error` is the sum of these shifts:
+    a guaranteed bound on how far (in rows) the rank of a returned quantile can be from the
+    true one. Sketches built on separate chunks or partitions can be combined with merge.
+    """
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.n = 0
+        self.rank_error = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1))))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                # Keep an odd value out, then promote every other sorted value
+                values = np.sort(self.levels[level])
+                kept = values[len(values) - len(values) % 2:]
+                values = values[:len(values) - len(values) % 2]
+                promoted = values[self._rng.integers(2)::2]
+
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = kept
+                self.rank_error += 2 ** level
+
+                # Capacities depend on the number of levels, so start again from the bottom
+                level = 0
+                continue
+            level += 1
+
+    def update(self, values):
+        """Add the non-missing values of an array or Series to the sketch and return it."""
+
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+        return self
+
+    def merge(self, other):
+        """Add the values summarized by another sketch to this one and return it."""
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+
+        self.n += other.n
+        self.rank_error += other.rank_error
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+        return self
+
+    def value_at_ranks(self, ranks):
+        """Return the approximate values at 0-based ranks."""
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2 ** level) for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+
+        # The extremes are tracked exactly
+        ranks = np.asarray(ranks)
+        result = values[np.minimum(np.searchsorted(cumulative, ranks, side='right'), len(values) - 1)]
+        result = np.where(ranks <= 0, self.min, result)
+
+        return np.where(ranks >= self.n - 1, self.max, result)
+
+    def quantiles(self, qs):
+        """Return the approximate quantiles qs, interpolated like np.quantile."""
+
+        positions = (self.n - 1) * np.asarray(qs, dtype=float)
+        low, high = self.value_at_ranks(np.floor(positions)), self.value_at_ranks(np.ceil(positions))
+
+        return low + (positions - np.floor(positions)) * (high - low)
+
+
+def quantile_sketch(chunks, column='Valuation', k=200):
+    """Return a QuantileSketch of column over an iterable of chunks."""
+
+    sketch = QuantileSketch(k)
+    for chunk in chunks:
+        sketch.update(chunk[column])
+
+    return sketch
+
+
+def exact_quantiles(make_chunks, qs, column='Valuation', k=200):
+    """Return the exact quantiles qs of column, interpolated like np.quantile, in two passes.
+
+    make_chunks is called once per pass and must return a fresh iterable of chunks. The
+    first pass builds a sketch, which brackets every rank needed within its rank_error; the
+    second pass counts the values below each bracket and how often each distinct value inside
+    it occurs, so memory stays bounded by the sketch and the distinct values of the brackets,
+    however many rows share a value.
+    """
+
+    sketch = quantile_sketch(make_chunks(), column, k)
+    positions = (sketch.n - 1) * np.asarray(qs, dtype=float)
+    ranks = np.unique(np.concatenate([np.floor(positions), np.ceil(positions)]).astype(np.int64))
+
+    margin = sketch.rank_error + 1
+    while True:
+        low = sketch.value_at_ranks(ranks - margin)
+        high = sketch.value_at_ranks(ranks + margin)
+
+        below = np.zeros(len(ranks), dtype=np.int64)
+        inside = [(np.empty(0), np.empty(0, dtype=np.int64)) for _ in ranks]
+        for chunk in make_chunks():
+            values = chunk[column].dropna().to_numpy(dtype=float)
+            for i in range(len(ranks)):
+                below[i] += (values < low[i]).sum()
+                chunk_values, chunk_counts = np.unique(values[(values >= low[i]) & (values <= high[i])],
+                                                       return_counts=True)
+
+                # Merge with the counts of the earlier chunks, sorted by value
+                merged, slots = np.unique(np.concatenate([inside[i][0], chunk_values]), return_inverse=True)
+                counts = np.bincount(slots, weights=np.concatenate([inside[i][1], chunk_counts]),
+                                     minlength=len(merged)).astype(np.int64)
+                inside[i] = merged, counts
+
+        offsets = ranks - below
+
+        # Widen the brackets if the sketch was further off than its bound allowed for
+        if all(0 <= offset < counts.sum() for offset, (_, counts) in zip(offsets, inside)):
+            break
+        margin *= 2
+
+    # The value at offset is the first distinct value whose running count passes it
+    exact = {rank: values[np.searchsorted(np.cumsum(counts), offset, side='right')]
+             for rank, offset, (values, counts) in zip(ranks, offsets, inside)}
+    low = np.array([exact[rank] for rank in np.floor(positions).astype(np.int64)])
+    high = np.array([exact[rank] for rank in np.ceil(positions).astype(np.int64)])
+
+    return low + (positions - np.floor(positions)) * (high - low)
+
+
+def quantile_codes(values, edges):
+    """Return the bin code of each value for bin edges, matching the codes of pd.qcut.
+
+    Bins are closed on the right and the first bin includes the lowest edge; missing values
+    get -1.
+    """
+
+    values = pd.Series(values)
+    codes = np.searchsorted(np.asarray(edges)[1:-1], values.to_numpy(dtype=float), side='left')
+
+    return pd.Series(np.where(values.isna(), -1, codes).astype(np.int8), index=values.index)
+
+
+# ## Compaction
+
+# Columns that hold numbers, never packed as indicators even if they only contain 0 and 1
+numeric_columns = ['Valuation', 'Year Founded', 'Years To Unicorn', 'Country/Region']
+
+
+def _frame_bytes(frame):
+    """Return the memory used by each column of frame, in bytes."""
+
+    return frame.memory_usage(deep=True, index=False)
+
+
+def _is_indicator(column):
+    """Return True if column is a bool column or an integer column of only 0 and 1."""
+
+    if pd.api.types.is_bool_dtype(column):
+        return True
+
+    return pd.api.types.is_integer_dtype(column) and column.isin([0, 1]).all()
+
+
+def compact_companies(frame, category_ratio=0.5, pack_indicators=True):
+    """Return a compact copy of frame and a report of the bytes saved per column.
+
+    Integers and floats are downcast, string columns with few distinct values (at most
+    category_ratio of the rows) become categoricals and the rest Arrow-backed strings, and
+    0/1 indicator columns are packed as bits into 'Indicators <n>' columns of up to 64
+    indicators each. frame.attrs['indicator_bits'] records which column is in which bit,
+    for expand_indicators.
+    """
+
+    before = _frame_bytes(frame)
+    compact = frame.copy()
+
+    # Arrow-backed strings need pyarrow, otherwise unique strings are left as they are
+    string_dtype = pd.StringDtype('pyarrow') if importlib.util.find_spec('pyarrow') else None
+
+    indicators = []
+    for name in compact.columns:
+        column = compact[name]
+
+        if pack_indicators and name not in numeric_columns and _is_indicator(column):
+            indicators.append(name)
+        elif pd.api.types.is_integer_dtype(column) and not pd.api.types.is_bool_dtype(column):
+            compact[name] = pd.to_numeric(column, downcast='integer')
+        elif pd.api.types.is_float_dtype(column):
+            compact[name] = pd.to_numeric(column, downcast='float')
+        elif pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column):
+            if column.nunique() <= category_ratio * len(column):
+                compact[name] = column.astype('category')
+            elif string_dtype is not None:
+                compact[name] = column.astype(string_dtype)
+
+    # Pack the indicators 64 at a time into the smallest unsigned integer that holds them
+    packed = {}
+    for start in range(0, len(indicators), 64):
+        group = indicators[start:start + 64]
+        dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                     if np.iinfo(dtype).bits >= len(group))
+        bits = np.zeros(len(compact), dtype=dtype)
+        for bit, name in enumerate(group):
+            bits |= compact[name].to_numpy().astype(dtype) << dtype(bit)
+        packed[f'Indicators {start // 64}'] = (bits, group)
+
+    compact = compact.drop(columns=indicators)
+    for name, (bits, _) in packed.items():
+        compact[name] = bits
+    compact.attrs['indicator_bits'] = {name: group for name, (_, group) in packed.items()}
+
+    after = _frame_bytes(compact)
+    report = pd.DataFrame({'before': before, 'after': after.reindex(before.index, fill_value=0),
+                           'dtype': compact.dtypes.reindex(before.index).astype(str)})
+    for name, (_, group) in packed.items():
+        report.loc[group, 'dtype'] = f'bit of {name}'
+        report.loc[name] = [0, after[name], str(compact[name].dtype)]
+    report['saved'] = report['before'] - report['after']
+
+    return compact, report
+
+
+def expand_indicators(compact):
+    """Return compact with the packed indicator columns unpacked into uint8 columns."""
+
+    frame = compact.copy()
+    for name, group in compact.attrs.get('indicator_bits', {}).items():
+        bits = frame.pop(name).to_numpy()
+        for bit, column in enumerate(group):
+            frame[column] = ((bits >> bits.dtype.type(bit)) & 1).astype(np.uint8)
+    frame.attrs.pop('indicator_bits', None)
+
+    return frame
+
+
+# ## Cache of the cleaned data
+
+# Directory holding the cached cleaned frames
+cache_dir = '.companies_cache'
+
+# Revision of the cleaning code, part of the cache key
+cleaning_rules_revision = 1
+
+
+def file_hash(path, block_size=1024 ** 2):
+    """Return the SHA-256 hex digest of the file at path."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cleaning_rules_hash():
+    """Return a hash of the cleaning rules, used as the rules part of the cache key."""
+
+    rules = {'revision': cleaning_rules_revision,
+             'industry_dct': industry_dct,
+             'industry_list': industry_list,
+             'year_founded_fixes': year_founded_fixes,
+             'industry_match_threshold': industry_match_threshold,
+             'loaded_industry_matches': {label: list(match) for label, match in loaded_industry_matches.items()},
+             'dtypes': {col: str(dtype) for col, dtype in companies_dtypes.items()},
+             'date_joined_format': date_joined_format}
+
+    return hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+
+
+def dataset_version(source):
+    """Return the version of the cleaned data of source: a hash of the file and one of the rules."""
+
+    return f'{file_hash(source)[:16]}-{cleaning_rules_hash()[:16]}'
+
+
+def cache_path(source):
+    """Return the cache file for the cleaned version of source under the current rules."""
+
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(cache_dir, f'{stem}-{dataset_version(source)}.arrow')
+
+
+def save_cleaned_cache(frame, source):
+    """Write the cleaned frame to the cache for source and return the cache file."""
+
+    from pyarrow import Table, feather
+
+    path = cache_path(source)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary name first so a crash never leaves a half-written cache
+    feather.write_feather(Table.from_pandas(frame), path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def load_cleaned_cache(source):
+    """Return the cached cleaned frame for source, or None if there is no cache for it."""
+
+    from pyarrow import feather
+
+    path = cache_path(source)
+    if not os.path.exists(path):
+        return None
+
+    # The file is uncompressed so it can be memory-mapped instead of read into memory
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+def load_or_clean_companies(source):
+    """Return the cleaned companies frame for source, from the cache when possible."""
+
+    frame = load_cleaned_cache(source)
+
+    if frame is None:
+        frame = clean_companies(read_companies(source))
+        save_cleaned_cache(frame, source)
+
+    return frame
+
+
+# ## Incremental cleaning
+
+def _current_generation(state_dir):
+    """Return the directory holding the encoders and parts of the state, or None before the first update."""
+
+    try:
+        with open(os.path.join(state_dir, 'CURRENT')) as f:
+            return os.path.join(state_dir, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def _set_generation(state_dir, name):
+    """Make the generation directory name the current one, then delete the other generations."""
+
+    current = os.path.join(state_dir, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(name)
+    os.replace(current + '.tmp', current)
+
+    _remove_stale_generations(state_dir)
+
+
+def _remove_stale_generations(state_dir):
+    """Delete the generation directories other than the current one, e.g. left by a crashed update."""
+
+    current = _current_generation(state_dir)
+    for name in os.listdir(state_dir):
+        path = os.path.join(state_dir, name)
+        if name.startswith('gen-') and path != current:
+            shutil.rmtree(path)
+
+
+def incremental_parts(state_dir):
+    """Return the part files of the incremental state in state_dir, oldest first."""
+
+    generation = _current_generation(state_dir)
+    if generation is None:
+        return []
+
+    return sorted(os.path.join(generation, name) for name in os.listdir(generation) if name.endswith('.arrow'))
+
+
+def _keys_path(state_dir):
+    return os.path.join(state_dir, 'companies.keys')
+
+
+def _append_keys(state_dir, part, companies):
+    """Append the companies of part as one line of the keys file of state_dir."""
+
+    with open(_keys_path(state_dir), 'a') as f:
+        f.write(json.dumps([os.path.basename(part), list(companies)]) + '\n')
+
+
+def seen_companies(state_dir):
+    """Return the set of companies already in the incremental state.
+
+    The companies of every part are appended to a keys file when the part is written, so
+    the parts themselves are not read. A part without its line (a crash between writing
+    the part and its keys) has its companies read from the part and appended.
+    """
+
+    from pyarrow import feather
+
+    seen, recorded = set(), set()
+
+    if os.path.exists(_keys_path(state_dir)):
+        with open(_keys_path(state_dir), 'r+') as f:
+            valid = 0
+            for line in iter(f.readline, ''):
+                # Cut off a line left half-written by a crash
+                if not line.endswith('\n'):
+                    f.truncate(valid)
+                    break
+                part, companies = json.loads(line)
+                recorded.add(part)
+                seen.update(companies)
+                valid = f.tell()
+
+    for part in incremental_parts(state_dir):
+        if os.path.basename(part) not in recorded:
+            companies = feather.read_table(part, columns=['Company']).column('Company').to_pylist()
+            _append_keys(state_dir, part, companies)
+            seen.update(companies)
+
+    return seen
+
+
+def _grow_encoders(encoders, frame):
+    """Return encoders with the values of frame outside their vocabulary added, or None if there are none.
+
+    Only encoders with unknown='error' are grown; the others already accept unknown values.
+    """
+
+    grown = dict(encoders)
+    for column, encoder in encoders.items():
+        if encoder.unknown == 'error':
+            new = set(frame[column].dropna()) - set(encoder.categories)
+            if new:
+                grown[column] = CategoryEncoder(list(encoder.categories) + sorted(new), encoder.unknown)
+
+    return grown if any(grown[column] is not encoders[column] for column in encoders) else None
+
+
+def _encode_part(frame, encoders, investors):
+    """Return the cleaned frame with its encodings added, keeping the investor flags as the last columns."""
+
+    flags = frame[investors]
+    frame = encode_categories(frame.drop(columns=investors), encoders)
+
+    return pd.concat([frame, flags], axis=1)
+
+
+def _decode_part(frame, encoders, investors):
+    """Undo _encode_part: drop the dummy columns and turn the Country/Region codes back into labels."""
+
+    dummies = [str(category) for column in ['Continent', 'Industry'] for category in encoders[column].categories[1:]]
+    frame = frame.drop(columns=dummies)
+
+    categories = encoders['Country/Region'].categories
+    frame['Country/Region'] = pd.Categorical.from_codes(frame['Country/Region'].to_numpy(), categories)
+
+    return frame
+
+
+def _write_part(frame, path):
+    """Write frame to the part file path under a temporary name first, so a crash never leaves a half-written part."""
+
+    from pyarrow import Table, feather
+
+    feather.write_feather(Table.from_pandas(frame, preserve_index=False), path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+
+
+def update_incremental_state(state_dir, source, encoders=None, investors=big_3_investors):
+    """Clean and encode the companies in source that are not in the state yet, save them as a new part and return how many there were.
+
+    The state keeps its encoders in state_dir: the given ones, or ones fitted on the first
+    update. An update bringing a Continent or Country/Region value outside their vocabulary
+    grows them and re-encodes the earlier parts; it is the only case where an update
+    rewrites the history. The encoders and the parts encoded with them live in a generation
+    directory named in the CURRENT file. The re-encoded parts and the grown encoders are
+    written to a new generation, and CURRENT is only switched to it once it is complete, so a
+    crash never leaves parts and encoders that do not match.
+    """
+
+    from pyarrow import feather
+
+    seen = seen_companies(state_dir)
+
+    # Read every column as text and convert and clean only the first row of each new company
+    delta = pd.read_csv(source, dtype=str)
+    delta = delta[~delta['Company'].duplicated().to_numpy() & ~in_seen(delta['Company'], seen)]
+
+    if len(delta) == 0:
+        return 0
+
+    delta = delta.astype({col: dtype for col, dtype in companies_dtypes.items() if col in delta})
+    delta = clean_chunk(delta, investors)
+
+    os.makedirs(state_dir, exist_ok=True)
+    _remove_stale_generations(state_dir)
+
+    generation = _current_generation(state_dir)
+    if generation is None:
+        generation = os.path.join(state_dir, 'gen-00000')
+        os.makedirs(generation)
+        encoders = encoders or fit_encoders(delta)
+        save_encoders(encoders, os.path.join(generation, 'encoders.json'))
+        _set_generation(state_dir, os.path.basename(generation))
+    else:
+        encoders = load_encoders(os.path.join(generation, 'encoders.json'))
+
+    grown = _grow_encoders(encoders, delta)
+    if grown is not None:
+        name = f'gen-{int(os.path.basename(generation)[4:]) + 1:05d}'
+        os.makedirs(os.path.join(state_dir, name))
+        for part in incremental_parts(state_dir):
+            frame = _decode_part(feather.read_table(part).to_pandas(), encoders, investors)
+            _write_part(_encode_part(frame, grown, investors), os.path.join(state_dir, name, os.path.basename(part)))
+        save_encoders(grown, os.path.join(state_dir, name, 'encoders.json'))
+
+        _set_generation(state_dir, name)
+        generation, encoders = os.path.join(state_dir, name), grown
+
+    path = os.path.join(generation, f'part-{len(incremental_parts(state_dir)):05d}.arrow')
+    _write_part(_encode_part(delta, encoders, investors), path)
+    _append_keys(state_dir, path, delta['Company'])
+
+    return len(delta)
+
+
+def load_incremental_companies(state_dir):
+    """Return the cleaned and encoded companies frame from the incremental state."""
+
+    from pyarrow import concat_tables, feather
+
+    tables = [feather.read_table(part, memory_map=True) for part in incremental_parts(state_dir)]
+    frame = concat_tables(tables, promote_options='permissive').to_pandas()
+
+    # The median split depends on every row, so it is the one encoding done on load
+    high_valuation = pd.qcut(frame['Valuation'], 2, labels = ['No','Yes']).cat.codes
+    frame.insert(frame.columns.get_loc('Years To Unicorn') + 1, 'High Valuation', high_valuation)
+
+    return frame
+
+
+# ## Out-of-core deduplication
+
+# Ways to choose the row kept for a duplicated company: the columns to sort a company's rows
+# by, and whether each is ascending. The first row after sorting is kept. '_row' is the
+# position of the row in the file.
+dedup_policies = {'first': (['_row'], [True]),
+                  'last': (['_row'], [False]),
+                  'latest': (['Date Joined', '_row'], [False, True])}
+
+
+def dedup_out_of_core(path, out_path, policy='first', partitions=64, chunk_rows=100_000, normalize_keys=False,
+                      work_dir=None):
+    """Write the rows of path to out_path with one row per Company, without loading the whole file.
+
+    Rows are hash-partitioned by Company into files in work_dir (a temporary directory by
+    default), each partition is deduplicated in memory with the given policy from
+    dedup_policies, and the surviving rows are written back in file order. With
+    normalize_keys, companies are compared after trimming and case-folding. Only one
+    partition or chunk_rows rows are held in memory at a time. Returns a dict with the
+    number of rows read, duplicated and written.
+    """
+
+    import tempfile
+
+    columns, ascending = dedup_policies[policy]
+
+    def key(frame):
+        company = frame['Company'].astype(str)
+        return company.str.strip().str.casefold() if normalize_keys else company
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+
+        def append(name, frame):
+            file = os.path.join(tmp, name)
+            frame.to_csv(file, mode='a', header=not os.path.exists(file), index=False)
+
+        # Pass 1: split the file into partitions by a hash of the company key
+        rows_in = 0
+        for chunk in read_companies(path, chunksize=chunk_rows):
+            chunk.insert(0, '_row', np.arange(rows_in, rows_in + len(chunk)))
+            rows_in += len(chunk)
+            buckets = pd.util.hash_pandas_object(key(chunk), index=False).to_numpy() % partitions
+            for partition, rows in chunk.groupby(buckets):
+                append(f'partition-{partition}.csv', rows)
+
+        # Pass 2: deduplicate each partition, then regroup the survivors by file position
+        rows_out = 0
+        for partition in range(partitions):
+            file = os.path.join(tmp, f'partition-{partition}.csv')
+            if not os.path.exists(file):
+                continue
+            rows = read_companies(file).sort_values(columns, ascending=ascending, kind='stable')
+            rows = rows[~key(rows).duplicated()]
+            rows_out += len(rows)
+            for block, survivors in rows.groupby(rows['_row'].to_numpy() // chunk_rows):
+                append(f'block-{block}.csv', survivors)
+
+        # Pass 3: write the survivors block by block in file order
+        first = True
+        for block in range(-(-rows_in // chunk_rows)):
+            file = os.path.join(tmp, f'block-{block}.csv')
+            if not os.path.exists(file):
+                continue
+            rows = read_companies(file).sort_values('_row').drop(columns='_row')
+            rows.to_csv(out_path, mode='w' if first else 'a', header=first, index=False)
+            first = False
+
+    return {'rows': rows_in, 'duplicates': rows_in - rows_out, 'rows written': rows_out}
+
+
+# ## Parallel cleaning
+
+def clean_partition(partition, encoders=None):
+    """Clean one partition of rows that holds every row of its companies."""
+
+    partition = clean_chunk(partition)
+    partition = partition[~partition['Company'].duplicated()]
+
+    if encoders is not None:
+        partition = encode_categories(partition, encoders)
+
+    return partition
+
+
+def clean_companies_parallel(frame, workers=None, partitions=None, encoders=None):
+    """Return frame cleaned and deduplicated on Company by a pool of worker processes."""
+
+    workers = workers or os.cpu_count()
+    partitions = partitions or workers
+
+    # The original row order is restored from the index, so it must identify each row
+    if not frame.index.is_unique:
+        frame = frame.reset_index(drop=True)
+
+    # Send every row of a company to the same partition
+    keys = pd.util.hash_pandas_object(frame['Company'], index=False).to_numpy() % partitions
+    parts = [frame[keys == i] for i in range(partitions)]
+
+    with ProcessPoolExecutor(workers) as pool:
+        cleaned = pd.concat(pool.map(clean_partition, parts, [encoders] * partitions))
+
+    # Put the surviving rows back in file order
+    cleaned = cleaned.loc[frame.index[frame.index.isin(cleaned.index)]]
+
+    # Partitions can end up with different Industry categories, so rebuild the category
+    cleaned['Industry'] = cleaned['Industry'].astype('category')
+
+    return cleaned
+
+
+# ## Investor analysis
+
+@instrumented('investor_aggregates')
+def investor_aggregates(frame, investors=None, k=3):
+    """Return a dict of tidy per-investor tables: summary, industry, continent and top."""
+
+    matrix, vocabulary = investor_matrix(frame)
+    names = vocabulary
+
+    # Keep only the requested investors, labelled with the names given; a name given twice counts once
+    if investors is not None:
+        investors = list(dict.fromkeys(investors))
+        columns = vocabulary.get_indexer(normalize_investors(pd.Series(investors, dtype=str)))
+        matrix = matrix[:, columns[columns >= 0]]
+        names = pd.Index(investors)[columns >= 0]
+
+    # One row per (company, investor) pair
+    pairs = matrix.tocoo()
+    long = frame.iloc[pairs.row][['Company', 'Valuation', 'Years To Unicorn', 'Industry', 'Continent']]
+    long.insert(0, 'Investor', pd.Categorical.from_codes(pairs.col, categories=names))
+
+    by_investor = long.groupby('Investor', observed=True)
+
+    summary = by_investor['Years To Unicorn'].agg(['count', 'mean', 'median'])
+    summary.columns = ['Companies', 'Mean Years To Unicorn', 'Median Years To Unicorn']
+
+    industry = long.groupby(['Investor', 'Industry'], observed=True).size().rename('Companies')
+    continent = long.groupby(['Investor', 'Continent'], observed=True).size().rename('Companies')
+
+    # Top k companies by Valuation for each investor, ties kept in file order
+    top = long.reset_index(drop=True)
+    largest = top.groupby('Investor', observed=True)['Valuation'].nlargest(k)
+    top = top.loc[largest.index.get_level_values(-1) if len(largest) else []]
+    top['Rank'] = top.groupby('Investor', observed=True).cumcount() + 1
+
+    return {'summary': summary,
+            'industry': industry.reset_index(),
+            'continent': continent.reset_index(),
+            'top': top[['Investor', 'Rank', 'Company', 'Valuation']].reset_index(drop=True)}
+
+
+class InvestorIndex:
+    """Posting lists from each investor to the row positions of their companies in frame.
+
+    Each posting list is ordered by descending Valuation (ties keep file order). Investor
+    names are matched the same way as in flag_investors.
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        matrix, self.investors = investor_matrix(frame)
+
+        # Rank rows by descending Valuation, then store each investor's ranks in a CSC column
+        self.order = np.argsort(-frame['Valuation'].to_numpy(), kind='stable')
+        postings = matrix[self.order].tocsc()
+        postings.sort_indices()
+        self.indptr, self.ranks = postings.indptr, postings.indices
+
+    def _ranks(self, investor):
+        """Return the sorted valuation ranks of investor's companies."""
+
+        i = self.investors.get_indexer(normalize_investors(pd.Series([investor], dtype=str)))[0]
+        if i < 0:
+            return self.ranks[:0]
+
+        return self.ranks[self.indptr[i]:self.indptr[i + 1]]
+
+    def positions(self, investor):
+        """Return the row positions of investor's companies, highest Valuation first."""
+
+        return self.order[self._ranks(investor)]
+
+    def portfolio(self, investor):
+        """Return the rows of investor's companies, highest Valuation first."""
+
+        return self.frame.iloc[self.positions(investor)]
+
+    def top_k(self, investor, k=3, column='Company'):
+        """Return column for the k highest valued companies of investor."""
+
+        return self.frame[column].to_numpy()[self.order[self._ranks(investor)[:k]]]
+
+    def mean(self, investor, column='Years To Unicorn'):
+        """Return the mean of column over investor's companies."""
+
+        return self.frame[column].to_numpy()[self.positions(investor)].mean()
+
+    def co_investments(self, *investors):
+        """Return the row positions of companies backed by all of investors, highest Valuation first."""
+
+        ranks = self._ranks(investors[0])
+        for investor in investors[1:]:
+            ranks = np.intersect1d(ranks, self._ranks(investor), assume_unique=True)
+
+        return self.order[ranks]
+
+
+def co_investment_pairs(matrix, investors, top_n=20, by='overlap'):
+    """Return the top_n investor pairs by shared companies ('overlap') or by 'jaccard'."""
+
+    # Shared company counts for every pair of investors, with portfolio sizes on the diagonal
+    matrix = matrix.astype(np.int32)
+    shared = (matrix.T @ matrix).tocoo()
+    sizes = shared.diagonal()
+
+    # Keep each pair once
+    upper = shared.row < shared.col
+    a, b, overlap = shared.row[upper], shared.col[upper], shared.data[upper]
+    jaccard = overlap / (sizes[a] + sizes[b] - overlap)
+
+    # Select the top pairs without sorting all of them
+    score = overlap if by == 'overlap' else jaccard
+    if len(score) > top_n:
+        keep = np.argpartition(-score, top_n)[:top_n]
+        a, b, overlap, jaccard = a[keep], b[keep], overlap[keep], jaccard[keep]
+
+    pairs = pd.DataFrame({'investor a': investors[a], 'investor b': investors[b],
+                          'overlap': overlap, 'jaccard': jaccard})
+
+    return pairs.sort_values(by, ascending=False, kind='stable').reset_index(drop=True)
+
+
+def co_investment_groups(matrix, investors, k=3, top_n=20):
+    """Return the top_n groups of k investors by the number of companies they all backed."""
+
+    matrix = matrix.tocsr()
+    matrix.sort_indices()
+    degrees = np.diff(matrix.indptr)
+
+    groups = []
+    for degree in np.unique(degrees[degrees >= k]):
+
+        # Investor columns of every company with this many investors, one company per row
+        rows = np.flatnonzero(degrees == degree)
+        columns = matrix.indices[matrix.indptr[rows][:, None] + np.arange(degree)]
+
+        # Every k-combination of each company's investors
+        groups.append(columns[:, list(combinations(range(degree), k))].reshape(-1, k))
+
+    if not groups:
+        return pd.DataFrame(columns=[f'investor {i + 1}' for i in range(k)] + ['overlap'])
+
+    groups, counts = np.unique(np.concatenate(groups), axis=0, return_counts=True)
+    keep = np.argsort(-counts, kind='stable')[:top_n]
+
+    result = pd.DataFrame({f'investor {i + 1}': investors[groups[keep, i]] for i in range(k)})
+    result['overlap'] = counts[keep]
+
+    return result
+
+
+# ## Charts
+
+# Change when the look of the charts changes, so cached files are redrawn
+chart_style_revision = 1
+
+
+def _chart_prefix(out_dir, investor, kind):
+    """Return the part of a chart file name shared by every fingerprint of that chart."""
+
+    # The slug keeps the name readable; the hash tells apart names that differ only in punctuation
+    slug = ''.join(ch if ch.isalnum() else '_' for ch in investor)
+    name_hash = hashlib.sha256(investor.encode()).hexdigest()[:8]
+
+    return os.path.join(out_dir, f'{slug}_{name_hash}-{kind}-')
+
+
+def _chart_path(out_dir, investor, kind, counts, ylim, fmt):
+    """Return the file for a chart of counts, named after a fingerprint of its data."""
+
+    data = {'revision': chart_style_revision, 'investor': investor, 'kind': kind,
+            'counts': {str(label): int(count) for label, count in counts.items()},
+            'ylim': None if ylim is None else [float(limit) for limit in ylim]}
+    fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+    return f'{_chart_prefix(out_dir, investor, kind)}{fingerprint}.{fmt}'
+
+
+def _prune_charts(out_dir, investor, kind, keep, fmt):
+    """Delete the files of a chart whose fingerprint is not the one in keep."""
+
+    pattern = glob.escape(_chart_prefix(out_dir, investor, kind)) + '?' * 16 + f'.{glob.escape(fmt)}'
+    for path in glob.glob(pattern):
+        if path != keep:
+            os.remove(path)
+
+
+def render_chart(path, investor, xlabel, counts, ylim=None):
+    """Draw a bar plot of counts for investor and save it to path."""
+
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 5))
+    ax = fig.subplots()
+
+    sns.barplot(x=counts.index, y=counts.values, ax=ax)
+    ax.set_title(investor)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Number of invested companies")
+    ax.tick_params(axis='x', labelrotation=90)
+    if ylim is not None:
+        ax.set(ylim=ylim)
+
+    fig.savefig(path, bbox_inches='tight')
+
+    return path
+
+
+def render_investor_charts(aggregates, out_dir='charts', fmt='png', workers=None, continent_ylim=None):
+    """Render the industry and continent charts of every investor in aggregates and return their files.
+
+    The continent charts share continent_ylim so investors can be compared side by side. By default it
+    runs from 0 to the largest continent count of any investor.
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Continents are always shown in the same alphabetical order, with 0 for missing ones
+    continents = sorted(aggregates['continent']['Continent'].unique())
+    if continent_ylim is None:
+        continent_ylim = (0, int(aggregates['continent']['Companies'].max()))
+
+    charts = []
+    for investor, industry in aggregates['industry'].groupby('Investor', observed=True):
+        counts = industry.set_index('Industry')['Companies'].sort_values(ascending=False)
+        charts.append((investor, 'industry', 'Industry', counts, None))
+
+    for investor, continent in aggregates['continent'].groupby('Investor', observed=True):
+        counts = continent.set_index('Continent')['Companies'].reindex(continents, fill_value=0)
+        charts.append((investor, 'continent', 'Continent', counts, continent_ylim))
+
+    paths = [_chart_path(out_dir, investor, kind, counts, ylim, fmt) for investor, kind, _, counts, ylim in charts]
+
+    # Charts drawn from older data or an older style are superseded by the new fingerprint
+    for path, (investor, kind, *_) in zip(paths, charts):
+        _prune_charts(out_dir, investor, kind, path, fmt)
+
+    # Only draw the charts that are not on disk yet
+    missing = [(path, investor, xlabel, counts, ylim)
+               for path, (investor, _, xlabel, counts, ylim) in zip(paths, charts) if not os.path.exists(path)]
+
+    if missing:
+        with ProcessPoolExecutor(workers) as pool:
+            list(pool.map(render_chart, *zip(*missing)))
+
+    return paths
+
+
+# ## Query service
+
+# Number of query results kept by each QueryService
+query_cache_size = 1024
+
+# Columns returned for the rows of a query when none are listed
+query_columns = ['Company', 'Valuation', 'Industry', 'Country/Region', 'Continent', 'Year Founded',
+                 'Years To Unicorn']
+
+query_aggregates = ['count', 'mean', 'median', 'sum', 'min', 'max']
+
+# Placeholder for a query result that is not in the cache (None is a valid result)
+_not_cached = object()
+
+
+def _json_value(value):
+    """Return value as a plain Python number, with NaN (e.g. the mean of no rows) as None.
+
+    Dates and durations (e.g. the min of Date Joined) become ISO strings.
+    """
+
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    elif isinstance(value, np.timedelta64):
+        value = pd.Timedelta(value)
+
+    if value is pd.NaT:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+
+    value = value.item() if hasattr(value, 'item') else value
+    return None if isinstance(value, float) and np.isnan(value) else value
+
+
+class QueryService:
+    """One resident copy of the cleaned companies data answering batches of queries.
+
+    A query is a dict of optional filters, which are all applied:
+
+        investor, industry, continent   a value or a list of values, any of which matches
+        min_investors                   {'investors': [...], 'min': 2}, rows backed by at
+                                        least min of the investors
+
+    and either an aggregate, {'func': 'mean', 'column': 'Years To Unicorn'} with an optional
+    'by' column to group on, or the matching rows ordered by 'by' (default Valuation,
+    highest first), limited to the first 'top' rows and to 'columns'. For example the
+    companies with two or more of the Big 3 investors:
+
+        {'min_investors': {'investors': big_3_investors, 'min': 2}, 'columns': ['Company']}
+
+    Results are kept in an LRU cache, which is emptied when the data is replaced by a new
+    version. A query that fails gets {'error': message} as its result.
+    """
+
+    def __init__(self, frame, version=None, source=None, cache_size=query_cache_size):
+        self.source = source
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self._signature = self._source_signature()
+        self._reload_lock = None
+        self.version = None
+        self.set_data(frame, version)
+
+    @classmethod
+    def from_source(cls, source, cache_size=query_cache_size):
+        """Return a service for the cleaned data of the file at source, from the cache when possible."""
+
+        return cls(load_or_clean_companies(source), dataset_version(source), source, cache_size)
+
+    def set_data(self, frame, version=None):
+        """Replace the data and empty the result cache if the version changed."""
+
+        if version is None or version != self.version:
+            self.cache.clear()
+
+        self.frame = frame
+        self.version = version
+        self.index = InvestorIndex(frame)
+
+    def _source_signature(self):
+        if self.source is None:
+            return None
+        stat = os.stat(self.source)
+        return stat.st_mtime_ns, stat.st_size
+
+    async def refresh(self):
+        """Reload the data in a worker thread if the source file changed; return whether it did."""
+
+        if self.source is None:
+            return False
+
+        # Only one reload at a time; queries keep being answered from the old data meanwhile
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+
+        async with self._reload_lock:
+            signature = self._source_signature()
+            if signature == self._signature:
+                return False
+
+            loop = asyncio.get_running_loop()
+            version = await loop.run_in_executor(None, dataset_version, self.source)
+            if version != self.version:
+                frame = await loop.run_in_executor(None, load_or_clean_companies, self.source)
+                self.set_data(frame, version)
+            self._signature = signature
+
+            return True
+
+    def _mask(self, query, frame, index):
+        """Return a boolean mask of the rows of frame that pass the filters of query."""
+
+        mask = np.ones(len(frame), dtype=bool)
+
+        for key, column in [('industry', 'Industry'), ('continent', 'Continent')]:
+            if key in query:
+                values = query[key] if isinstance(query[key], list) else [query[key]]
+                mask &= frame[column].isin(values).to_numpy()
+
+        if 'investor' in query:
+            investors = query['investor'] if isinstance(query['investor'], list) else [query['investor']]
+            backed = np.zeros(len(frame), dtype=bool)
+            for investor in investors:
+                backed[index.positions(investor)] = True
+            mask &= backed
+
+        if 'min_investors' in query:
+            investors = query['min_investors']['investors']
+            positions = [index.positions(investor) for investor in investors]
+            counts = np.bincount(np.concatenate(positions), minlength=len(frame))
+            mask &= counts >= query['min_investors'].get('min', 1)
+
+        return mask
+
+    def _answer(self, query, frame, index):
+        """Compute the result of one query on frame and its InvestorIndex."""
+
+        if not isinstance(query, dict):
+            raise ValueError(f'a query must be a JSON object, not {query!r}')
+
+        unknown = set(query) - {'investor', 'industry', 'continent', 'min_investors',
+                                'aggregate', 'by', 'top', 'columns'}
+        if unknown:
+            raise ValueError(f'unknown query keys: {sorted(unknown)}')
+
+        for key in ['aggregate', 'min_investors']:
+            if key in query and not isinstance(query[key], dict):
+                raise ValueError(f'{key} must be a JSON object, not {query[key]!r}')
+
+        mask = self._mask(query, frame, index)
+
+        if 'aggregate' in query:
+            rows = frame[mask]
+            func = query['aggregate'].get('func', 'count')
+            if func not in query_aggregates:
+                raise ValueError(f'unknown aggregate {func!r}, expected one of {query_aggregates}')
+
+            values = rows[query['aggregate'].get('column', 'Company')]
+            if 'by' in query:
+                result = getattr(values.groupby(rows[query['by']], observed=True), func)()
+                return {str(key): _json_value(value) for key, value in result.items()}
+            return _json_value(getattr(values, func)())
+
+        # Highest first, ties in file order; the index already holds the rows in Valuation order
+        if query.get('by', 'Valuation') == 'Valuation':
+            positions = index.order[mask[index.order]]
+            rows = frame.iloc[positions[:query['top']] if 'top' in query else positions]
+        else:
+            rows = frame[mask].sort_values(query['by'], ascending=False, kind='stable')
+            if 'top' in query:
+                rows = rows.head(query['top'])
+
+        return json.loads(rows[query.get('columns', query_columns)].to_json(orient='records', date_format='iso'))
+
+    def _compute(self, queries, frame, index):
+        """Return a (result, cacheable) pair for each of queries; failed queries are not cached."""
+
+        results = []
+        for query in queries:
+            # One bad query must not cost the rest of the batch its results
+            try:
+                result = self._answer(query, frame, index)
+                json.dumps(result)
+                results.append((result, True))
+            except Exception as error:
+                results.append(({'error': f'{type(error).__name__}: {error}'}, False))
+
+        return results
+
+    def _cached(self, keys):
+        """Return the cached result of each key, or _not_cached for the keys that are not cached."""
+
+        results = []
+        for key in keys:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                results.append(self.cache[key])
+            else:
+                self.misses += 1
+                results.append(_not_cached)
+
+        return results
+
+    def _store(self, key, result):
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def run(self, queries):
+        """Return the results of a list of queries, from the cache when possible."""
+
+        keys = [json.dumps(query, sort_keys=True) for query in queries]
+        results = self._cached(keys)
+
+        missing = [i for i, result in enumerate(results) if result is _not_cached]
+        computed = self._compute([queries[i] for i in missing], self.frame, self.index)
+        for i, (result, cacheable) in zip(missing, computed):
+            if cacheable:
+                self._store(keys[i], result)
+            results[i] = result
+
+        return results
+
+    async def query_batch(self, queries):
+        """Return the results of a list of queries against the current version of the data.
+
+        Queries missing from the cache are answered in a worker thread, so a slow batch does
+        not hold up the other connections.
+        """
+
+        # The data of this batch, which a refresh may replace while the worker runs
+        frame, index, version = self.frame, self.index, self.version
+
+        keys = [json.dumps(query, sort_keys=True) for query in queries]
+        results = self._cached(keys)
+
+        missing = [i for i, result in enumerate(results) if result is _not_cached]
+        if missing:
+            loop = asyncio.get_running_loop()
+            computed = await loop.run_in_executor(None, self._compute, [queries[i] for i in missing], frame, index)
+            for i, (result, cacheable) in zip(missing, computed):
+                if cacheable and self.version == version:
+                    self._store(keys[i], result)
+                results[i] = result
+
+        return results
+
+
+async def serve_queries(service, host='127.0.0.1', port=8765, refresh_seconds=5.0):
+    """Answer batches of queries sent to host:port until cancelled.
+
+    Each request is one line of JSON holding a list of queries (or a single query) and is
+    answered with one line of JSON holding {'version': ..., 'results': [...]}. Every
+    refresh_seconds the source file of service is checked for a new version.
+    """
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            try:
+                queries = json.loads(line)
+            except ValueError as error:
+                response = {'version': service.version, 'error': f'invalid JSON: {error}'}
+            else:
+                queries = queries if isinstance(queries, list) else [queries]
+                version = service.version
+                response = {'version': version, 'results': await service.query_batch(queries)}
+
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+        writer.close()
+        await writer.wait_closed()
+
+    async def refresh():
+        while True:
+            await asyncio.sleep(refresh_seconds)
+
+            # The file can be missing or half-written while it is replaced; keep serving and try again
+            try:
+                await service.refresh()
+            except Exception as error:
+                print(f'Could not refresh {service.source}: {error!r}', file=sys.stderr)
+
+    server = await asyncio.start_server(handle, host, port, limit=2 ** 24)
+    refresher = asyncio.create_task(refresh())
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        refresher.cancel()
+
+
+async def request_queries(queries, host='127.0.0.1', port=8765):
+    """Send a batch of queries to a running serve_queries and return its response."""
+
+    reader, writer = await asyncio.open_connection(host, port, limit=2 ** 24)
+
+    writer.write(json.dumps(queries).encode() + b'\n')
+    await writer.drain()
+    response = json.loads(await reader.readline())
+
+    writer.close()
+    await writer.wait_closed()
+
+    return response
+
+
+# ## DataFrame backends
+
+class PandasBackend:
+    """The cleaning and analysis steps on eager pandas frames, using the functions above."""
+
+    name = 'pandas'
+
+    def scan(self, path):
+        return read_companies(path)
+
+    def distinct(self, frame, column):
+        return pd.Series(frame[column].dropna().unique())
+
+    def parse_dates(self, frame):
+        return parse_date_joined(frame)
+
+    def fix_year_founded(self, frame):
+        return fix_year_founded(frame)
+
+    def years_to_unicorn(self, frame):
+        return add_years_to_unicorn(frame)
+
+    def relabel_industry(self, frame, mapping):
+        # normalize_industry looks the labels up in the same industry_matches as mapping
+        return relabel_industry(frame)
+
+    def drop_duplicates(self, frame):
+        return drop_duplicate_companies(frame)
+
+    def encode(self, frame, encoders):
+        return encode_companies(frame, encoders)
+
+    def flag_investors(self, frame, investors):
+        return flag_investors(frame, investors)
+
+    def collect(self, frame):
+        return frame
+
+    def investor_results(self, frame, investors, k=3, min_investors=2):
+        aggregates = investor_aggregates(frame, investors, k)
+        backed = frame[list(investors)].sum(axis=1) >= min_investors
+
+        return {'summary': aggregates['summary'][['Companies', 'Mean Years To Unicorn']],
+                'top': aggregates['top'],
+                'overlap': pd.Series(frame.loc[backed, 'Company'].to_numpy(), name='Company')}
+
+
+class PolarsBackend:
+    """The cleaning and analysis steps as a lazy Polars query.
+
+    Nothing is read until collect (or a distinct) runs the query, so Polars can push the
+    column selection and the filters of the analysis down into the CSV scan and run the
+    steps on all cores. Unlike CategoryEncoder.dummies, labels missing from the vocabulary of
+    an encoder get 0 in every dummy column instead of raising, and investor names are
+    lowercased instead of case-folded.
+    """
+
+    name = 'polars'
+
+    def __init__(self):
+        import polars
+
+        self.pl = polars
+
+    def scan(self, path):
+        pl = self.pl
+        types = {str: pl.String, 'category': pl.String, 'int16': pl.Int16, 'int32': pl.Int32}
+        schema = {col: types[dtype] for col, dtype in companies_dtypes.items()}
+
+        return pl.scan_csv(path, schema_overrides=schema)
+
+    def distinct(self, frame, column):
+        values = frame.select(self.pl.col(column).drop_nulls().unique(maintain_order=True)).collect()
+        return values.to_series().to_pandas()
+
+    def parse_dates(self, frame):
+        pl = self.pl
+        return frame.with_columns(pl.col('Date Joined').str.strptime(pl.Datetime('us'), date_joined_format))
+
+    def fix_year_founded(self, frame):
+        pl = self.pl
+        year = pl.col('Company').replace_strict(year_founded_fixes, default=pl.col('Year Founded'),
+                                                return_dtype=pl.Int16)
+        return frame.with_columns(year.alias('Year Founded'))
+
+    def years_to_unicorn(self, frame):
+        pl = self.pl
+        years = pl.col('Date Joined').dt.year() - pl.col('Year Founded')
+        return frame.with_columns(years.alias('Years To Unicorn'))
+
+    def relabel_industry(self, frame, mapping):
+        return frame.with_columns(self.pl.col('Industry').replace(mapping))
+
+    def drop_duplicates(self, frame):
+        return frame.unique(subset=['Company'], keep='first', maintain_order=True)
+
+    def _codes(self, column, encoder):
+        pl = self.pl
+        dtype = pl.Int8 if len(encoder.categories) < 128 else pl.Int16
+        mapping = {category: i for i, category in enumerate(encoder.categories)}
+
+        # Unknown values fail when the query runs, like CategoryEncoder with unknown='error'
+        if encoder.unknown == 'ignore':
+            return pl.col(column).replace_strict(mapping, default=-1, return_dtype=dtype)
+        return pl.col(column).replace_strict(mapping, return_dtype=dtype)
+
+    def _dummies(self, column, encoder):
+        pl = self.pl
+        return [(pl.col(column) == category).fill_null(False).cast(pl.UInt8).alias(str(category))
+                for category in encoder.categories[1:]]
+
+    def encode(self, frame, encoders):
+        pl = self.pl
+
+        # Same as the median split of pd.qcut(Valuation, 2)
+        high = (pl.col('Valuation') > pl.col('Valuation').median()).cast(pl.Int8).alias('High Valuation')
+
+        frame = frame.with_columns(high)
+        frame = frame.with_columns(self._dummies('Continent', encoders['Continent']))
+        frame = frame.with_columns(self._codes('Country/Region', encoders['Country/Region']))
+        return frame.with_columns(self._dummies('Industry', encoders['Industry']))
+
+    def flag_investors(self, frame, investors):
+        pl = self.pl
+        if not len(investors):
+            return frame
+
+        # Split Select Investors once, as investor_matrix does, keeping the position in investors
+        # of every name that is wanted
+        wanted = {' '.join(investor.split()).lower(): i for i, investor in enumerate(investors)}
+        name = (pl.element().str.strip_chars().str.replace_all(r'\s+', ' ').str.to_lowercase()
+                .replace_strict(wanted, default=None, return_dtype=pl.Int32))
+        found = pl.col('Select Investors').fill_null('').str.split(',').list.eval(name.drop_nulls())
+
+        flags = [pl.col('__investors_found').list.contains(i).cast(pl.Int64).alias(investor)
+                 for i, investor in enumerate(investors)]
+
+        return frame.with_columns(found.alias('__investors_found')).with_columns(flags).drop('__investors_found')
+
+    def collect(self, frame):
+        return frame.collect().to_pandas()
+
+    def investor_results(self, frame, investors, k=3, min_investors=2):
+        pl = self.pl
+
+        # One row per (company, investor) pair; only the columns used here are read from the file
+        companies = frame.select('Company', 'Valuation', 'Years To Unicorn', *investors)
+        long = (companies.unpivot(index=['Company', 'Valuation', 'Years To Unicorn'], on=investors,
+                                  variable_name='Investor')
+                .filter(pl.col('value') == 1)
+                .with_columns(pl.col('Investor').cast(pl.Enum(investors))))
+
+        summary = long.group_by('Investor').agg(pl.len().alias('Companies'),
+                                                pl.col('Years To Unicorn').mean().alias('Mean Years To Unicorn'))
+
+        # Top k companies by Valuation for each investor, ties kept in file order
+        top = (long.sort('Valuation', descending=True, maintain_order=True)
+               .group_by('Investor', maintain_order=True).head(k)
+               .sort('Investor', maintain_order=True)
+               .with_columns(pl.int_range(1, pl.len() + 1).over('Investor').alias('Rank'))
+               .select('Investor', 'Rank', 'Company', 'Valuation'))
+
+        overlap = companies.filter(pl.sum_horizontal(investors) >= min_investors).select('Company')
+
+        summary, top, overlap = pl.collect_all([summary.sort('Investor'), top, overlap])
+
+        return {'summary': summary.to_pandas().set_index('Investor'),
+                'top': top.to_pandas(),
+                'overlap': overlap.to_pandas()['Company']}
+
+
+# Backends that clean_with_backend can run on, by name
+dataframe_backends = {'pandas': PandasBackend, 'polars': PolarsBackend}
+
+
+def clean_with_backend(path, backend='pandas', encoders=None, investors=big_3_investors):
+    """Run the steps of clean_companies on the file at path with the named backend.
+
+    Returns the backend's frame, which is a lazy query for Polars; pass it to the backend's
+    collect to get a pandas DataFrame. The industry mapping and the encoders are worked
+    out from the distinct values of the columns, so both backends share them.
+    """
+
+    engine = dataframe_backends[backend]()
+
+    frame = engine.scan(path)
+    frame = engine.parse_dates(frame)
+    frame = engine.fix_year_founded(frame)
+    frame = engine.years_to_unicorn(frame)
+    frame = engine.relabel_industry(frame, industry_mapping(engine.distinct(frame, 'Industry')))
+    frame = engine.drop_duplicates(frame)
+
+    if encoders is None:
+        encoders = {'Continent': CategoryEncoder().fit(engine.distinct(frame, 'Continent')),
+                    'Country/Region': CategoryEncoder().fit(engine.distinct(frame, 'Country/Region')),
+                    'Industry': CategoryEncoder(industry_list, unknown='ignore')}
+    frame = engine.encode(frame, encoders)
+
+    return engine.flag_investors(frame, investors)
+
+
+def _comparable(frame):
+    """Return frame with plain Python values and a fresh index, so two backends can be compared."""
+
+    frame = pd.DataFrame(frame)
+    frame = frame.reset_index(drop=frame.index.name is None)
+    for column in frame:
+        if pd.api.types.is_datetime64_any_dtype(frame[column]):
+            frame[column] = frame[column].astype('datetime64[ns]')
+        elif pd.api.types.is_numeric_dtype(frame[column]):
+            frame[column] = frame[column].astype('float64')
+        else:
+            frame[column] = frame[column].astype(object).where(frame[column].notna(), None)
+
+    return frame
+
+
+def backend_parity(path, backends=('pandas', 'polars'), investors=big_3_investors):
+    """Run the cleaning and the Big 3 results on every backend and compare them with the first.
+
+    Returns a DataFrame with one row per check and backend, and the first difference found.
+    """
+
+    # Country/Region holds its label codes after the encodings, so it is compared with them
+    base_columns = [column for column in companies_dtypes if column != 'Country/Region'] + ['Years To Unicorn']
+    checks = {'InVision fix': lambda frame, results: frame.loc[frame['Company'].isin(list(year_founded_fixes)),
+                                                               ['Company', 'Year Founded', 'Years To Unicorn']],
+              'industry mapping': lambda frame, results: frame[['Company', 'Industry']],
+              'dedup': lambda frame, results: frame[['Company']],
+              'encodings': lambda frame, results: frame.drop(columns=base_columns + list(investors)),
+              'Big 3 flags': lambda frame, results: frame[['Company'] + list(investors)],
+              'Big 3 summary': lambda frame, results: results['summary'],
+              'Big 3 top companies': lambda frame, results: results['top'],
+              'Big 3 overlap': lambda frame, results: results['overlap']}
+
+    outputs = {}
+    for backend in backends:
+        engine = dataframe_backends[backend]()
+        cleaned = clean_with_backend(path, backend, investors=investors)
+        outputs[backend] = engine.collect(cleaned), engine.investor_results(cleaned, investors)
+
+    rows = []
+    expected = outputs[backends[0]]
+    for backend in backends[1:]:
+        for check, select in checks.items():
+            try:
+                pd.testing.assert_frame_equal(_comparable(select(*outputs[backend])), _comparable(select(*expected)))
+                difference = ''
+            except AssertionError as error:
+                difference = ' '.join(str(error).split())
+            rows.append({'check': check, 'backend': backend, 'passed': not difference, 'difference': difference})
+
+    return pd.DataFrame(rows, columns=['check', 'backend', 'passed', 'difference'])
+
+
+# ## Command line
+
+def main(argv=None):
+    """Run the command line interface and return its exit status."""
+
+    parser = argparse.ArgumentParser(description='Clean, validate and analyse the unicorn companies data.')
+    parser.add_argument('--metrics', help='JSON-lines file to append the measurements of every stage to')
+    parser.add_argument('--rows-modified', action='store_true', help='count the rows each stage modifies (slower)')
+    parser.add_argument('--trace-memory', action='store_true', help='measure stage memory with tracemalloc (slower)')
+    parser.add_argument('--profile-dir', help='directory to save a cProfile file of every stage call into')
+    parser.add_argument('--industry-matches', help='JSON file of industry matches, read if it exists and saved on exit')
+    parser.add_argument('--review-queue', help='CSV file to write the industry labels waiting for review to')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    validate_parser = commands.add_parser('validate', help='check a file against validation_rules')
+    validate_parser.add_argument('path')
+    validate_parser.add_argument('--chunk-rows', type=int, default=100_000, help='rows read at a time')
+    validate_parser.add_argument('--report', help='CSV file to write the violations to')
+
+    clean_parser = commands.add_parser('clean', help='write a cleaned copy of a file, chunk by chunk')
+    clean_parser.add_argument('path')
+    clean_parser.add_argument('out')
+    clean_parser.add_argument('--chunk-rows', type=int, help='rows per chunk (default: from --byte-budget)')
+    clean_parser.add_argument('--byte-budget', type=int, default=stream_byte_budget, help='memory budget of one chunk')
+    clean_parser.add_argument('--encoders', help='JSON file of fitted encoders to apply to every chunk')
+
+    dedup_parser = commands.add_parser('dedup', help='write a copy of a file with one row per Company, out of core')
+    dedup_parser.add_argument('path')
+    dedup_parser.add_argument('out')
+    dedup_parser.add_argument('--policy', choices=sorted(dedup_policies), default='first',
+                              help='which row of a duplicated company to keep')
+    dedup_parser.add_argument('--partitions', type=int, default=64, help='number of partitions on disk')
+    dedup_parser.add_argument('--chunk-rows', type=int, default=100_000, help='rows read at a time')
+    dedup_parser.add_argument('--work-dir', help='directory for the partition files')
+
+    report_parser = commands.add_parser('report', help='print the per-investor statistics of a file')
+    report_parser.add_argument('path')
+    report_parser.add_argument('--investors', nargs='+', default=big_3_investors, help='investors to report on')
+    report_parser.add_argument('--top', type=int, default=3, help='number of top companies by Valuation')
+    report_parser.add_argument('--no-cache', action='store_true', help='clean the file without the Arrow cache')
+    report_parser.add_argument('--charts', help='directory to render the investor charts into')
+
+    serve_parser = commands.add_parser('serve', help='answer batches of JSON queries on the cleaned data')
+    serve_parser.add_argument('path')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    serve_parser.add_argument('--refresh', type=float, default=5.0, help='seconds between checks for a new file')
+
+    parity_parser = commands.add_parser('parity', help='check that the DataFrame backends give the same results')
+    parity_parser.add_argument('path')
+    parity_parser.add_argument('--backends', nargs='+', choices=sorted(dataframe_backends),
+                               default=['pandas', 'polars'], help='backends to compare, against the first one')
+
+    args = parser.parse_args(argv)
+
+    if args.profile_dir and not args.metrics:
+        parser.error('--profile-dir requires --metrics')
+
+    if args.industry_matches and os.path.exists(args.industry_matches):
+        load_industry_matches(args.industry_matches)
+
+    hooks = [JsonLinesExporter(args.metrics, command=args.command)] if args.metrics else []
+    try:
+        with instrument(*hooks, rows_modified=args.rows_modified, trace_memory=args.trace_memory,
+                        profile_dir=args.profile_dir):
+            return run_command(args)
+    finally:
+        # Keep the matches and the labels left for review of this run, even when it failed
+        if args.industry_matches:
+            save_industry_matches(args.industry_matches)
+
+        review = industry_review_table()
+        if args.review_queue:
+            review.to_csv(args.review_queue, index=False)
+        if len(review):
+            print(f'Industry labels waiting for review ({len(review)}):', file=sys.stderr)
+            print(review.to_string(index=False), file=sys.stderr)
+
+
+def run_command(args):
+    """Run the subcommand parsed from the command line and return its exit status."""
+
+    if args.command == 'validate':
+
+        def chunks():
+            for chunk in read_companies(args.path, chunksize=args.chunk_rows):
+                chunk['Years To Unicorn'] = chunk['Date Joined'].dt.year - chunk['Year Founded']
+                yield chunk
+
+        violations = validate_chunks(chunks())
+        print(violations['rule'].value_counts().reindex([rule['name'] for rule in validation_rules], fill_value=0)
+              .to_string())
+        if args.report:
+            violations.to_csv(args.report, index=False)
+
+        return 1 if len(violations) else 0
+
+    if args.command == 'clean':
+        encoders = load_encoders(args.encoders) if args.encoders else None
+        print(clean_companies_streaming(args.path, args.out, args.chunk_rows, args.byte_budget, encoders))
+        return 0
+
+    if args.command == 'dedup':
+        counts = dedup_out_of_core(args.path, args.out, args.policy, args.partitions, args.chunk_rows,
+                                   work_dir=args.work_dir)
+        print('Number of duplicated companies (before cleaning):')
+        print(counts['duplicates'])
+        print('Number of rows written:')
+        print(counts['rows written'])
+        return 0
+
+    if args.command == 'serve':
+        service = QueryService.from_source(args.path)
+        print(f'Serving version {service.version} on {args.host}:{args.port}')
+        try:
+            asyncio.run(serve_queries(service, args.host, args.port, args.refresh))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == 'parity':
+        checks = backend_parity(args.path, args.backends)
+        print(checks[['check', 'backend', 'passed']].to_string(index=False))
+        for check in checks[~checks['passed']].itertuples():
+            print(f'{check.check} ({check.backend}): {check.difference}')
+        return 0 if checks['passed'].all() else 1
+
+    if args.no_cache:
+        frame = clean_companies(read_companies(args.path))
+    else:
+        frame = load_or_clean_companies(args.path)
+
+    aggregates = investor_aggregates(frame, args.investors, args.top)
+    print(aggregates['summary'].to_string())
+    print()
+    print(aggregates['top'].to_string(index=False))
+
+    if args.charts:
+        for path in render_investor_charts(aggregates, args.charts):
+            print(path)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())